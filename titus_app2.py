@@ -6,21 +6,21 @@ from io import BytesIO
 from fpdf import FPDF
 import numpy as np
 
-# Load the dataset
-data = pd.read_excel("titus_data.xlsx", sheet_name="Data")
-data.columns = data.iloc[0]  # Set first row as column names
-data = data[1:]  # Drop first row
-data.reset_index(drop=True, inplace=True)
-data['DATE'] = pd.to_datetime(data['DATE'], errors='coerce')
-
-# Convert numeric columns
-numeric_columns = ['Profit', 'Sales total', 'Cost total', 'WEIGHT', 'CBM', 'CTNS']
-for col in numeric_columns:
-    data[col] = pd.to_numeric(data[col], errors='coerce')
+from titus_filters import (BITMAP_COLUMNS, cascading_options, date_index, prefix_index, search_counts,
+                           select_rows, selection_cache, take_rows)
+from titus_loader import enable_copy_on_write, load_prepared, with_columns
+from titus_metrics import cube_scope, narrow_scope, share, size_by, sum_by
+from titus_query import QueryError, compile_query
+
+enable_copy_on_write()
+
+# Load the dataset from the snapshot prepared by titus_ingest.py (the workbook is only
+# parsed when it changed since); the description columns are only read when the
+# description filter is used
+data, summary = load_prepared("titus_data.xlsx")
 
 # Min/max dates
-min_date = data['DATE'].min()
-max_date = data['DATE'].max()
+min_date, max_date = summary["extents"]['DATE']
 
 # Load the logo
 logo_path = "titus_logo.jpg"
@@ -35,6 +35,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"  # Optional: "expanded" or "collapsed"
 )
 
+if data.attrs.get("coerced_dates"):
+    st.warning(f"{data.attrs['coerced_dates']} DATE values could not be read as dates and were left empty.")
+
 
 # Sidebar with logo and menu
 with st.sidebar:
@@ -79,52 +82,91 @@ with st.sidebar:
         else:
             date_range = (min_date, max_date)
 
+    # Filter options list the values still present under the other filters, with
+    # their row counts; values already picked always stay listed
+    picked = {col: st.session_state.get(f"filter {col}", []) for col in BITMAP_COLUMNS}
+    option_counts = cascading_options(data, picked)
+
+    def filter_multiselect(label, col):
+        counts = option_counts[col]
+        options = counts.index.tolist() + [value for value in picked[col] if value not in counts.index]
+        return st.multiselect(label, options=options, key=f"filter {col}",
+                              format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
+    # Columns with too many values to list are searched by prefix on the server; only the
+    # best matches and the values already picked are sent to the widget, counted under
+    # the filters picked on the other columns
+    def search_multiselect(label, col, counts=None):
+        index = prefix_index(data, col)
+        counts = search_counts(data, col, picked) if counts is None else counts
+        prefix = st.text_input(label, key=f"search {col}", placeholder="Type the first characters to search")
+        matches = index.search(prefix, counts=counts)
+        selected = st.session_state.get(f"filter {col}", [])
+        options = matches.index.tolist() + [value for value in selected if value not in matches.index]
+        return st.multiselect(label, options=options, key=f"filter {col}", label_visibility="collapsed",
+                              format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
     # Destination Filter
     with st.expander("Destination Filters"):
-        destination = st.multiselect("Select Destination", options=data['Destination'].unique())
+        destination = filter_multiselect("Select Destination", 'Destination')
 
     # Shipment Filters
     with st.expander("Shipment Filters"):
-        shipment_number = st.multiselect("Select Shipment Number", options=data['Shipment NO.'].unique())
-        warehouse = st.multiselect("Select Loading Warehouse", options=data['Loading warehouse'].unique())
+        shipment_number = search_multiselect("Select Shipment Number", 'Shipment NO.')
+        warehouse = filter_multiselect("Select Loading Warehouse", 'Loading warehouse')
 
     # Client Filters
     with st.expander("Client Filters"):
-        client_code = st.multiselect("Select Client Code", options=data['Client code'].unique())
-        client_level = st.multiselect("Select Client Level", options=data['Client level'].unique())
+        client_code = search_multiselect("Select Client Code", 'Client code', option_counts['Client code'])
+        client_level = filter_multiselect("Select Client Level", 'Client level')
 
     # Sales and Goods Filters
     with st.expander("Sales and Goods Filters"):
-        salesperson = st.multiselect("Select Salesperson", options=data['Sales'].unique())
-        mark = st.multiselect("Select Mark (Label)", options=data['Mark'].unique())
-        category1 = st.multiselect("Select Main Category", options=data['Category1'].unique())
-        category2 = st.multiselect("Select Subcategory", options=data['Category2'].unique())
-        description = st.multiselect("Select Description", options=data['Description in E'].unique())
-        goods_type = st.multiselect("Select Goods Type", options=data['goods tpye'].unique())
+        salesperson = filter_multiselect("Select Salesperson", 'Sales')
+        mark = filter_multiselect("Select Mark (Label)", 'Mark')
+        category1 = filter_multiselect("Select Main Category", 'Category1')
+        category2 = filter_multiselect("Select Subcategory", 'Category2')
+        description = []
+        if st.checkbox("Filter by Description"):
+            try:
+                data = with_columns(data, ['Description in EN'])
+                description = search_multiselect("Select Description", 'Description in EN')
+            except FileNotFoundError as error:
+                st.warning(f"Descriptions are unavailable: {error}")
+        goods_type = filter_multiselect("Select Goods Type", 'goods tpye')
 
     # Transport Type Filter
     with st.expander("Transport Filters"):
-        transport_type = st.multiselect("Select Transport Type", options=data['Type'].unique())
+        transport_type = filter_multiselect("Select Transport Type", 'Type')
 
     # Range Filters for Profit, Weight, and CBM
     with st.expander("Range Filters"):
         profit_range = st.slider(
             "Profit Range",
-            min_value=int(data['Profit'].min()),
-            max_value=int(data['Profit'].max()),
-            value=(int(data['Profit'].min()), int(data['Profit'].max()))
+            min_value=int(summary["extents"]['Profit'][0]),
+            max_value=int(summary["extents"]['Profit'][1]),
+            value=(int(summary["extents"]['Profit'][0]), int(summary["extents"]['Profit'][1]))
         )
         weight_range = st.slider(
             "Weight Range",
-            min_value=int(data['WEIGHT'].min()),
-            max_value=int(data['WEIGHT'].max()),
-            value=(int(data['WEIGHT'].min()), int(data['WEIGHT'].max()))
+            min_value=int(summary["extents"]['WEIGHT'][0]),
+            max_value=int(summary["extents"]['WEIGHT'][1]),
+            value=(int(summary["extents"]['WEIGHT'][0]), int(summary["extents"]['WEIGHT'][1]))
         )
         cbm_range = st.slider(
             "CBM Range",
-            min_value=float(data['CBM'].min()),
-            max_value=float(data['CBM'].max()),
-            value=(float(data['CBM'].min()), float(data['CBM'].max()))
+            min_value=float(summary["extents"]['CBM'][0]),
+            max_value=float(summary["extents"]['CBM'][1]),
+            value=(float(summary["extents"]['CBM'][0]), float(summary["extents"]['CBM'][1]))
+        )
+
+    # Expression Filter
+    with st.expander("Expression Filter"):
+        query_text = st.text_input(
+            "Filter expression",
+            placeholder='Destination in ("Lagos", "Dubai") and Profit > 500 and DATE >= 2024-06-01',
+            help="Combine conditions on any column with and / or / not. Quote text values, write dates "
+                 "as YYYY-MM-DD and put column names with spaces in backticks, e.g. `Client code` = \"C001\"."
         )
 
     # Filter Button
@@ -133,83 +175,37 @@ with st.sidebar:
 
 # Apply Filters
 if st.session_state.filters_applied:
-    filtered_data = data.copy()
-
-    # Date Range Filter
-    filtered_data = filtered_data[
-        (filtered_data['DATE'] >= pd.to_datetime(date_range[0])) &
-        (filtered_data['DATE'] <= pd.to_datetime(date_range[1]))
-    ]
-
-    # Destination Filter
-    if destination:
-        filtered_data = filtered_data[filtered_data['Destination'].isin(destination)]
-
-    # Shipment Number Filter
-    if shipment_number:
-        filtered_data = filtered_data[filtered_data['Shipment NO.'].isin(shipment_number)]
-
-    # Loading Warehouse Filter
-    if warehouse:
-        filtered_data = filtered_data[filtered_data['Loading warehouse'].isin(warehouse)]
-
-    # Client Code Filter
-    if client_code:
-        filtered_data = filtered_data[filtered_data['Client code'].isin(client_code)]
-
-    # Client Level Filter
-    if client_level:
-        filtered_data = filtered_data[filtered_data['Client level'].isin(client_level)]
-
-    # Salesperson Filter
-    if salesperson:
-        filtered_data = filtered_data[filtered_data['Sales'].isin(salesperson)]
-
-    # Mark Filter
-    if mark:
-        filtered_data = filtered_data[filtered_data['Mark'].isin(mark)]
-
-    # Main Category Filter
-    if category1:
-        filtered_data = filtered_data[filtered_data['Category1'].isin(category1)]
-
-    # Subcategory Filter
-    if category2:
-        filtered_data = filtered_data[filtered_data['Category2'].isin(category2)]
-
-    # Description Filter
-    if description:
-        filtered_data = filtered_data[filtered_data['Description in E'].isin(description)]
-
-    # Goods Type Filter
-    if goods_type:
-        filtered_data = filtered_data[filtered_data['goods tpye'].isin(goods_type)]
-
-    # Transport Type Filter
-    if transport_type:
-        filtered_data = filtered_data[filtered_data['Type'].isin(transport_type)]
-
-    # Profit Range Filter
-    filtered_data = filtered_data[
-        (filtered_data['Profit'] >= profit_range[0]) &
-        (filtered_data['Profit'] <= profit_range[1])
-    ]
-
-    # Weight Range Filter
-    filtered_data = filtered_data[
-        (filtered_data['WEIGHT'] >= weight_range[0]) &
-        (filtered_data['WEIGHT'] <= weight_range[1])
-    ]
-
-    # CBM Range Filter
-    filtered_data = filtered_data[
-        (filtered_data['CBM'] >= cbm_range[0]) &
-        (filtered_data['CBM'] <= cbm_range[1])
-    ]
+    # Every filter is resolved on the shared indexes of the dataset and the matching
+    # rows are taken once, without copying the shared columns; results are cached
+    # per filter state
+    filters = {
+        'Destination': destination, 'Shipment NO.': shipment_number, 'Loading warehouse': warehouse,
+        'Client code': client_code, 'Client level': client_level, 'Sales': salesperson, 'Mark': mark,
+        'Category1': category1, 'Category2': category2, 'Description in EN': description,
+        'goods tpye': goods_type, 'Type': transport_type,
+    }
+    ranges = {'Profit': profit_range, 'WEIGHT': weight_range, 'CBM': cbm_range}
+    dates = (date_range[0], date_range[1])
+    try:
+        query = compile_query(query_text) if query_text.strip() else None
+        # The expression may read description columns that are only loaded on demand
+        query_data = data if query is None else with_columns(data, query.columns)
+        rows = select_rows(query_data, filters, dates, ranges, query)
+    except QueryError as error:
+        st.sidebar.error(f"Expression ignored: {error}")
+        query = None
+        rows = select_rows(data, filters, dates, ranges)
+    filtered_data = take_rows(data, rows)
+    # Charts grouped by cube dimensions are read off the daily cube when the filters allow it
+    scope = cube_scope(data, filters, dates, ranges, query)
 
     st.success(f"Filtered Data: {len(filtered_data)} records found!")
+    cache_stats = selection_cache.stats()
+    st.sidebar.caption(f"Filter cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                       f"({cache_stats['refined']} refined from an earlier result)")
 else:
-    filtered_data = data.copy()
+    filtered_data = data.copy(deep=False)  # Shares the columns of data until they are modified
+    scope = cube_scope(data)
 
 # Display Filtered Data
 #st.subheader("Filtered Data")
@@ -263,7 +259,7 @@ if page == "Main Dashboard":
     # Generate Bar Chart Based on User Selections
     if not filtered_data.empty:  # Ensure there is data to display
         aggregated_data = (
-            filtered_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+            sum_by(filtered_data, aggregation_basis, numeric_metric, scope)
         )
         bar_chart = px.bar(
             aggregated_data,
@@ -293,7 +289,7 @@ if page == "Main Dashboard":
     if not filtered_data.empty:
         if trend_category == "None":
             # Group data by DATE and calculate the sum of Sales and Cost
-            time_series_data = filtered_data.groupby("DATE")[["Sales total", "Cost total"]].sum().reset_index()
+            time_series_data = sum_by(filtered_data, "DATE", ["Sales total", "Cost total"], scope)
 
             # Create a line chart for overall trend
             sales_cost_chart = px.line(
@@ -305,7 +301,7 @@ if page == "Main Dashboard":
             )
         else:
             # Group data by DATE and selected category
-            time_series_data = filtered_data.groupby(["DATE", trend_category])[["Sales total", "Cost total"]].sum().reset_index()
+            time_series_data = sum_by(filtered_data, ["DATE", trend_category], ["Sales total", "Cost total"], scope)
 
             # Show all categories by default
             category_values = time_series_data[trend_category].unique().tolist()
@@ -328,7 +324,7 @@ if page == "Main Dashboard":
             )
 
             # Create a combined column for unique coloring
-            melted_data["Category_Metric"] = melted_data[trend_category] + " - " + melted_data["Metric"]
+            melted_data["Category_Metric"] = melted_data[trend_category].astype(str) + " - " + melted_data["Metric"]
 
             # Create a line chart with distinct colors for each Category + Metric combination
             sales_cost_chart = px.line(
@@ -360,7 +356,7 @@ if page == "Main Dashboard":
     client_data = filtered_data[filtered_data['Client level'] == selected_client]
 
     # Group data by Category and calculate total profit
-    category_profit = client_data.groupby("Category1")["Profit"].sum().reset_index()
+    category_profit = client_data.groupby("Category1", observed=True)["Profit"].sum().reset_index()
 
     # Create a bar chart
     profit_bar_chart = px.bar(
@@ -419,18 +415,11 @@ if page == "Main Dashboard":
     # Generate the Chart Based on User Selections
     if not filtered_data.empty:  # Ensure there is data to display
         # Group data by selected aggregation_basis and secondary_dimension
-        aggregated_data = (
-            filtered_data.groupby([aggregation_basis, secondary_dimension])[numeric_metric]
-            .sum()
-            .reset_index()
-        )
+        aggregated_data = sum_by(filtered_data, [aggregation_basis, secondary_dimension], numeric_metric, scope)
 
         if display_option == "Percentage Share":
             # Calculate percentage share within each aggregation_basis group
-            aggregated_data["Percentage"] = (
-                aggregated_data.groupby(aggregation_basis)[numeric_metric]
-                .transform(lambda x: x / x.sum() * 100)
-            )
+            aggregated_data["Percentage"] = share(aggregated_data, numeric_metric, aggregation_basis)
             y_axis = "Percentage"  # Use percentage column for chart
             y_label = "Percentage Share (%)"
             chart_title = f"{numeric_metric} Percentage Share by {aggregation_basis} and {secondary_dimension}"
@@ -662,7 +651,7 @@ elif page == "Comparison Report":
 
         # Generate Stacked Bar Chart
         st.header(f"Stacked Bar Chart: {categorical1} and {categorical2}")
-        aggregated_data = filtered_data.groupby([categorical1, categorical2]).size().reset_index(name="Count")
+        aggregated_data = size_by(filtered_data, [categorical1, categorical2], scope, name="Count")
         fig = px.bar(
             aggregated_data,
             x=categorical1,
@@ -689,7 +678,7 @@ elif page == "Comparison Report":
         if categorical2 == "None":
             # Generate Grouped Bar Chart
             st.header(f"Grouped Bar Chart: {numeric_column} by {categorical1}")
-            aggregated_data = filtered_data.groupby(categorical1)[numeric_column].sum().reset_index()
+            aggregated_data = sum_by(filtered_data, categorical1, numeric_column, scope)
             fig = px.bar(
                 aggregated_data,
                 x=categorical1,
@@ -700,7 +689,7 @@ elif page == "Comparison Report":
         else:
             # Generate Stacked Bar Chart
             st.header(f"Stacked Bar Chart: {numeric_column} by {categorical1} and {categorical2}")
-            aggregated_data = filtered_data.groupby([categorical1, categorical2])[numeric_column].sum().reset_index()
+            aggregated_data = sum_by(filtered_data, [categorical1, categorical2], numeric_column, scope)
             fig = px.bar(
                 aggregated_data,
                 x=categorical1,
@@ -720,6 +709,8 @@ elif page == "Business Assessment":
     # Create the Business Assessment page
     def business_assessment():
         st.title("Business Assessment")
+        # Every section groups the whole dataset, read off the daily cube where it can
+        data_scope = cube_scope(data)
 
         # Section 1: Profitability Analysis
         st.header("1. Profitability Analysis")
@@ -729,13 +720,13 @@ elif page == "Business Assessment":
         with col2:
             aggregation = st.selectbox("Aggregate By", options=categorical_columns, index=0)
         if metric and aggregation:
-            agg_data = data.groupby(aggregation)[metric].sum().reset_index()
+            agg_data = sum_by(data, aggregation, metric, data_scope)
             fig = px.bar(agg_data, x=aggregation, y=metric, color=aggregation, title=f"{metric} by {aggregation}")
             st.plotly_chart(fig)
 
         # Section 2: Cost Efficiency
         st.header("2. Cost Efficiency")
-        cost_efficiency = data.groupby("Category1")[["Cost total", "Sales total"]].sum().reset_index()
+        cost_efficiency = sum_by(data, "Category1", ["Cost total", "Sales total"], data_scope)
         fig2 = px.bar(
             cost_efficiency,
             x="Category1",
@@ -748,7 +739,7 @@ elif page == "Business Assessment":
 
         # Section 3: Volume and Weight Analysis
         st.header("3. Volume and Weight Analysis")
-        volume_weight = data.groupby("Category1")[["CBM", "WEIGHT"]].sum().reset_index()
+        volume_weight = sum_by(data, "Category1", ["CBM", "WEIGHT"], data_scope)
         fig3 = px.scatter(
             volume_weight,
             x="CBM",
@@ -762,7 +753,7 @@ elif page == "Business Assessment":
 
         # Section 4: Shipment Trends
         st.header("4. Shipment Trends")
-        shipment_trend = data.groupby("DATE")[["Sales total", "Cost total"]].sum().reset_index()
+        shipment_trend = sum_by(data, "DATE", ["Sales total", "Cost total"], data_scope)
         fig4 = px.line(
             shipment_trend,
             x="DATE",
@@ -774,7 +765,7 @@ elif page == "Business Assessment":
 
         # Section 5: Client Segmentation
         st.header("5. Client Segmentation")
-        client_segmentation = data.groupby("Client level")[["Profit", "Sales total"]].sum().reset_index()
+        client_segmentation = sum_by(data, "Client level", ["Profit", "Sales total"], data_scope)
         fig5 = px.bar(
             client_segmentation,
             x="Client level",
@@ -825,32 +816,30 @@ elif page == "Comparison By Date":
     # Step 3: Filter Data for Each Period
     if not filtered_data.empty:
         # Filter for Period 1
-        period_1_data = filtered_data[
-            (filtered_data['DATE'] >= pd.to_datetime(start_date_1)) &
-            (filtered_data['DATE'] <= pd.to_datetime(end_date_1))
-        ]
+        period_1_data = date_index(data).filter(filtered_data, start_date_1, end_date_1)
         # Aggregate data for Period 1
-        period_1_agg = period_1_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+        period_1_agg = sum_by(period_1_data, aggregation_basis, numeric_metric,
+                              narrow_scope(scope, start_date_1, end_date_1))
         period_1_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 1)"}, inplace=True)
 
         # Filter for Period 2
-        period_2_data = filtered_data[
-            (filtered_data['DATE'] >= pd.to_datetime(start_date_2)) &
-            (filtered_data['DATE'] <= pd.to_datetime(end_date_2))
-        ]
+        period_2_data = date_index(data).filter(filtered_data, start_date_2, end_date_2)
         # Aggregate data for Period 2
-        period_2_agg = period_2_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+        period_2_agg = sum_by(period_2_data, aggregation_basis, numeric_metric,
+                              narrow_scope(scope, start_date_2, end_date_2))
         period_2_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 2)"}, inplace=True)
 
         # Step 4: Merge Period 1 and Period 2 Data
-        comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(0)
+        comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(
+            {f"{numeric_metric} (Period 1)": 0, f"{numeric_metric} (Period 2)": 0}
+        )
 
         # Calculate Percentage Difference
         comparison_data["% Difference"] = (
             (comparison_data[f"{numeric_metric} (Period 2)"] - comparison_data[f"{numeric_metric} (Period 1)"]) /
             comparison_data[f"{numeric_metric} (Period 1)"].replace(0, np.nan)
         ) * 100
-        comparison_data["% Difference"].fillna(0, inplace=True)
+        comparison_data["% Difference"] = comparison_data["% Difference"].fillna(0)
 
         # Step 5: Visualize the Comparison
         st.subheader(f"Comparison of {numeric_metric} by {aggregation_basis}")
@@ -6,6 +6,15 @@ from io import BytesIO
 from fpdf import FPDF
 import numpy as np
 
+from titus_filters import (BITMAP_COLUMNS, cascading_options, column_catalog, date_index, prefix_index,
+                           search_counts, select_rows, selection_cache, take_rows)
+from titus_loader import (LAZY_COLUMNS, BackgroundLoad, DeltaTracker, enable_copy_on_write, file_digest,
+                          load_workbooks, with_columns)
+from titus_metrics import cube_scope, narrow_scope, share, size_by, sum_by
+from titus_query import QueryError, compile_query
+
+enable_copy_on_write()
+
 # Set page configuration
 st.set_page_config(
     page_title="Titus App",
@@ -29,35 +38,92 @@ with st.sidebar:
     st.markdown("---")
 
 # Step 1: File Upload Section
-st.header("Upload Your Excel File")
-uploaded_file = st.file_uploader("Choose an Excel file", type=["xlsx"])
+st.header("Upload Your Excel Files")
+uploaded_files = st.file_uploader(
+    "Choose one or more Excel files (one export per branch or month)",
+    type=["xlsx"],
+    accept_multiple_files=True
+)
+streaming_load = st.checkbox(
+    "Low-memory loading",
+    help="Read the workbook in chunks of rows. Use it for year-long exports that run out of memory."
+)
 
-if uploaded_file:
-    # Read the uploaded Excel file
+if uploaded_files:
+    # Read the uploaded Excel files
     try:
-        data = pd.read_excel(uploaded_file, sheet_name="Data")
-        data.columns = data.iloc[0]  # Set the first row as column names
-        data = data[1:]  # Drop the first row
-        data.reset_index(drop=True, inplace=True)
-        data['DATE'] = pd.to_datetime(data['DATE'], errors='coerce')
-
-        # Convert numeric columns
-        numeric_columns = ['Profit', 'Sales total', 'Cost total', 'WEIGHT', 'CBM', 'CTNS']
-        for col in numeric_columns:
-            data[col] = pd.to_numeric(data[col], errors='coerce')
+        # New workbooks are parsed in parallel, known ones come from the cache;
+        # the 'Source file' column records which workbook each row came from.
+        # The load runs on a worker thread; reruns pick up the same load.
+        load_key = (tuple(file_digest(file.getvalue()) for file in uploaded_files), streaming_load)
+        if "load_job" not in st.session_state or st.session_state.load_job.key != load_key:
+            st.session_state.load_job = BackgroundLoad(load_key, load_workbooks, uploaded_files,
+                                                       streaming=streaming_load)
+        load_job = st.session_state.load_job
+
+        if not load_job.done():
+            # Skeleton of the sidebar and data table, shown until the data is ready
+            with st.sidebar:
+                st.title("Titus Logistics")
+                st.image(logo, width=100)
+                st.markdown("---")
+                st.caption("Filters will appear once the data is read and confirmed.")
+            st.subheader("Edit Your Data")
+
+            @st.fragment(run_every=0.5)
+            def load_progress():
+                # Only this fragment polls the load; the page reruns once the data is ready
+                if load_job.done():
+                    st.rerun()
+                if load_job.progress:
+                    st.progress(load_job.progress, text="Reading workbooks...")
+                else:
+                    # Nothing to measure until the sheet is read, unless it is read in chunks
+                    st.caption("⏳ Reading the sheet...")
+
+            load_progress()
+            st.dataframe(pd.DataFrame(), use_container_width=True)
+            st.button("Data Confirmed", disabled=True, key="skeleton Data Confirmed")
+            st.stop()
+
+        data = load_job.result()
+        if data.attrs.get("coerced_dates"):
+            st.warning(f"{data.attrs['coerced_dates']} DATE values could not be read as dates and were left empty.")
+
+        # Follow re-uploads and report the rows that changed since the previous one
+        filter_columns = ['Destination', 'Shipment NO.', 'Loading warehouse', 'Client code', 'Client level',
+                          'Sales', 'Mark', 'Category1', 'Category2', 'goods tpye', 'Type']
+        if "delta_tracker" not in st.session_state:
+            st.session_state.delta_tracker = DeltaTracker(filter_columns)
+        delta_tracker = st.session_state.delta_tracker
+        delta = delta_tracker.update(data)
+        if delta is not None and delta_tracker.version > 1:
+            st.info(f"{len(delta.added)} new or changed rows since the previous upload "
+                    f"({len(delta.removed)} rows replaced or removed).")
+
+        # The wide description columns stay on disk unless asked for
+        if st.checkbox("Include description columns",
+                       help="Load 'Description in EN' and 'Description in CN' to edit and filter on them."):
+            data = with_columns(data, LAZY_COLUMNS)
 
         # Step 2: Editable Data Table
         st.subheader("Edit Your Data")
-        edited_data = st.experimental_data_editor(data, use_container_width=True)
+        edited_data = st.data_editor(data, use_container_width=True)
 
         # Step 3: Confirm Data for Analysis
         if st.button("Data Confirmed"):
             st.success("Data Confirmed! Proceeding with analysis.")
-            data = edited_data.copy()
+            # Edited data is a new dataset version: it must not reuse the uploaded data's indexes
+            attrs = dict(data.attrs) if edited_data.equals(data) else {}
+            data = edited_data.copy(deep=False)
+            data.attrs = attrs
+
+            # Column statistics (value counts, extents, quartiles, roles), computed once per dataset
+            catalog = column_catalog(data)
 
             # Min/max dates for filtering
-            min_date = data['DATE'].min()
-            max_date = data['DATE'].max()
+            min_date = catalog['DATE'].low
+            max_date = catalog['DATE'].high
 
             # Sidebar with logo and menu
             with st.sidebar:
@@ -102,52 +168,101 @@ if uploaded_file:
                     else:
                         date_range = (min_date, max_date)
 
+                # Filter options list the values still present under the other filters, with
+                # their row counts; values already picked always stay listed. Until a filter is
+                # picked they are the counts the delta tracker keeps up to date across uploads.
+                picked = {col: st.session_state.get(f"filter {col}", []) for col in BITMAP_COLUMNS}
+                option_counts = None if any(map(len, picked.values())) else delta_tracker.counts(data)
+                if option_counts is None:
+                    option_counts = cascading_options(data, picked)
+
+                def filter_multiselect(label, col):
+                    counts = option_counts[col]
+                    options = counts.index.tolist() + [value for value in picked[col] if value not in counts.index]
+                    return st.multiselect(label, options=options, key=f"filter {col}",
+                                          format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
+                # Columns with too many values to list are searched by prefix on the server; only the
+                # best matches and the values already picked are sent to the widget, counted under
+                # the filters picked on the other columns
+                def search_multiselect(label, col, counts=None):
+                    index = prefix_index(data, col)
+                    counts = search_counts(data, col, picked) if counts is None else counts
+                    prefix = st.text_input(label, key=f"search {col}", placeholder="Type the first characters to search")
+                    matches = index.search(prefix, counts=counts)
+                    selected = st.session_state.get(f"filter {col}", [])
+                    options = matches.index.tolist() + [value for value in selected if value not in matches.index]
+                    return st.multiselect(label, options=options, key=f"filter {col}", label_visibility="collapsed",
+                                          format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
                 # Destination Filter
                 with st.expander("Destination Filters"):
-                    destination = st.multiselect("Select Destination", options=data['Destination'].unique())
+                    destination = filter_multiselect("Select Destination", 'Destination')
 
                 # Shipment Filters
                 with st.expander("Shipment Filters"):
-                    shipment_number = st.multiselect("Select Shipment Number", options=data['Shipment NO.'].unique())
-                    warehouse = st.multiselect("Select Loading Warehouse", options=data['Loading warehouse'].unique())
+                    shipment_number = search_multiselect("Select Shipment Number", 'Shipment NO.')
+                    warehouse = filter_multiselect("Select Loading Warehouse", 'Loading warehouse')
 
                 # Client Filters
                 with st.expander("Client Filters"):
-                    client_code = st.multiselect("Select Client Code", options=data['Client code'].unique())
-                    client_level = st.multiselect("Select Client Level", options=data['Client level'].unique())
+                    client_code = search_multiselect("Select Client Code", 'Client code', option_counts['Client code'])
+                    client_level = filter_multiselect("Select Client Level", 'Client level')
 
                 # Sales and Goods Filters
                 with st.expander("Sales and Goods Filters"):
-                    salesperson = st.multiselect("Select Salesperson", options=data['Sales'].unique())
-                    mark = st.multiselect("Select Mark (Label)", options=data['Mark'].unique())
-                    category1 = st.multiselect("Select Main Category", options=data['Category1'].unique())
-                    category2 = st.multiselect("Select Subcategory", options=data['Category2'].unique())
-                    description = st.multiselect("Select Description", options=data['Description in E'].unique())
-                    goods_type = st.multiselect("Select Goods Type", options=data['goods tpye'].unique())
+                    salesperson = filter_multiselect("Select Salesperson", 'Sales')
+                    mark = filter_multiselect("Select Mark (Label)", 'Mark')
+                    category1 = filter_multiselect("Select Main Category", 'Category1')
+                    category2 = filter_multiselect("Select Subcategory", 'Category2')
+                    if 'Description in EN' in data.columns:
+                        description = search_multiselect("Select Description", 'Description in EN')
+                    else:
+                        description = []
+                    goods_type = filter_multiselect("Select Goods Type", 'goods tpye')
 
                 # Transport Type Filter
                 with st.expander("Transport Filters"):
-                    transport_type = st.multiselect("Select Transport Type", options=data['Type'].unique())
+                    transport_type = filter_multiselect("Select Transport Type", 'Type')
 
                 # Range Filters for Profit, Weight, and CBM
                 with st.expander("Range Filters"):
+                    profit_stats = catalog['Profit']
+                    weight_stats = catalog['WEIGHT']
+                    cbm_stats = catalog['CBM']
+
+                    def quartiles(stats):
+                        return "Quartiles: " + " / ".join(f"{value:,.2f}" for value in stats.quartiles)
+
                     profit_range = st.slider(
                         "Profit Range",
-                        min_value=int(data['Profit'].min()),
-                        max_value=int(data['Profit'].max()),
-                        value=(int(data['Profit'].min()), int(data['Profit'].max()))
+                        min_value=int(profit_stats.low),
+                        max_value=int(profit_stats.high),
+                        value=(int(profit_stats.low), int(profit_stats.high)),
+                        help=quartiles(profit_stats)
                     )
                     weight_range = st.slider(
                         "Weight Range",
-                        min_value=int(data['WEIGHT'].min()),
-                        max_value=int(data['WEIGHT'].max()),
-                        value=(int(data['WEIGHT'].min()), int(data['WEIGHT'].max()))
+                        min_value=int(weight_stats.low),
+                        max_value=int(weight_stats.high),
+                        value=(int(weight_stats.low), int(weight_stats.high)),
+                        help=quartiles(weight_stats)
                     )
                     cbm_range = st.slider(
                         "CBM Range",
-                        min_value=float(data['CBM'].min()),
-                        max_value=float(data['CBM'].max()),
-                        value=(float(data['CBM'].min()), float(data['CBM'].max()))
+                        min_value=float(cbm_stats.low),
+                        max_value=float(cbm_stats.high),
+                        value=(float(cbm_stats.low), float(cbm_stats.high)),
+                        help=quartiles(cbm_stats)
+                    )
+
+                # Expression Filter
+                with st.expander("Expression Filter"):
+                    query_text = st.text_input(
+                        "Filter expression",
+                        placeholder='Destination in ("Lagos", "Dubai") and Profit > 500 and DATE >= 2024-06-01',
+                        help="Combine conditions on any column with and / or / not. Quote text values, write dates "
+                             "as YYYY-MM-DD and put column names with spaces in backticks, e.g. `Client code` = \"C001\"."
                     )
 
                 # Filter Button
@@ -156,83 +271,37 @@ if uploaded_file:
 
             # Apply Filters
             if st.session_state.filters_applied:
-                filtered_data = data.copy()
-
-                # Date Range Filter
-                filtered_data = filtered_data[
-                    (filtered_data['DATE'] >= pd.to_datetime(date_range[0])) &
-                    (filtered_data['DATE'] <= pd.to_datetime(date_range[1]))
-                ]
-
-                # Destination Filter
-                if destination:
-                    filtered_data = filtered_data[filtered_data['Destination'].isin(destination)]
-
-                # Shipment Number Filter
-                if shipment_number:
-                    filtered_data = filtered_data[filtered_data['Shipment NO.'].isin(shipment_number)]
-
-                # Loading Warehouse Filter
-                if warehouse:
-                    filtered_data = filtered_data[filtered_data['Loading warehouse'].isin(warehouse)]
-
-                # Client Code Filter
-                if client_code:
-                    filtered_data = filtered_data[filtered_data['Client code'].isin(client_code)]
-
-                # Client Level Filter
-                if client_level:
-                    filtered_data = filtered_data[filtered_data['Client level'].isin(client_level)]
-
-                # Salesperson Filter
-                if salesperson:
-                    filtered_data = filtered_data[filtered_data['Sales'].isin(salesperson)]
-
-                # Mark Filter
-                if mark:
-                    filtered_data = filtered_data[filtered_data['Mark'].isin(mark)]
-
-                # Main Category Filter
-                if category1:
-                    filtered_data = filtered_data[filtered_data['Category1'].isin(category1)]
-
-                # Subcategory Filter
-                if category2:
-                    filtered_data = filtered_data[filtered_data['Category2'].isin(category2)]
-
-                # Description Filter
-                if description:
-                    filtered_data = filtered_data[filtered_data['Description in E'].isin(description)]
-
-                # Goods Type Filter
-                if goods_type:
-                    filtered_data = filtered_data[filtered_data['goods tpye'].isin(goods_type)]
-
-                # Transport Type Filter
-                if transport_type:
-                    filtered_data = filtered_data[filtered_data['Type'].isin(transport_type)]
-
-                # Profit Range Filter
-                filtered_data = filtered_data[
-                    (filtered_data['Profit'] >= profit_range[0]) &
-                    (filtered_data['Profit'] <= profit_range[1])
-                ]
-
-                # Weight Range Filter
-                filtered_data = filtered_data[
-                    (filtered_data['WEIGHT'] >= weight_range[0]) &
-                    (filtered_data['WEIGHT'] <= weight_range[1])
-                ]
-
-                # CBM Range Filter
-                filtered_data = filtered_data[
-                    (filtered_data['CBM'] >= cbm_range[0]) &
-                    (filtered_data['CBM'] <= cbm_range[1])
-                ]
+                # Every filter is resolved on the shared indexes of the dataset and the matching
+                # rows are taken once, without copying the shared columns; results are cached
+                # per filter state
+                filters = {
+                    'Destination': destination, 'Shipment NO.': shipment_number, 'Loading warehouse': warehouse,
+                    'Client code': client_code, 'Client level': client_level, 'Sales': salesperson, 'Mark': mark,
+                    'Category1': category1, 'Category2': category2, 'Description in EN': description,
+                    'goods tpye': goods_type, 'Type': transport_type,
+                }
+                ranges = {'Profit': profit_range, 'WEIGHT': weight_range, 'CBM': cbm_range}
+                dates = (date_range[0], date_range[1])
+                try:
+                    query = compile_query(query_text) if query_text.strip() else None
+                    # The expression may read description columns that are only loaded on demand
+                    query_data = data if query is None else with_columns(data, query.columns)
+                    rows = select_rows(query_data, filters, dates, ranges, query)
+                except QueryError as error:
+                    st.sidebar.error(f"Expression ignored: {error}")
+                    query = None
+                    rows = select_rows(data, filters, dates, ranges)
+                filtered_data = take_rows(data, rows)
+                # Charts grouped by cube dimensions are read off the daily cube when the filters allow it
+                scope = cube_scope(data, filters, dates, ranges, query)
 
                 st.success(f"Filtered Data: {len(filtered_data)} records found!")
+                cache_stats = selection_cache.stats()
+                st.sidebar.caption(f"Filter cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                                   f"({cache_stats['refined']} refined from an earlier result)")
             else:
-                filtered_data = data.copy()
+                filtered_data = data.copy(deep=False)  # Shares the columns of data until they are modified
+                scope = cube_scope(data)
 
             # Display Filtered Data
             #st.subheader("Filtered Data")
@@ -286,7 +355,7 @@ if uploaded_file:
                 # Generate Bar Chart Based on User Selections
                 if not filtered_data.empty:  # Ensure there is data to display
                     aggregated_data = (
-                        filtered_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+                        sum_by(filtered_data, aggregation_basis, numeric_metric, scope)
                     )
                     bar_chart = px.bar(
                         aggregated_data,
@@ -316,7 +385,7 @@ if uploaded_file:
                 if not filtered_data.empty:
                     if trend_category == "None":
                         # Group data by DATE and calculate the sum of Sales and Cost
-                        time_series_data = filtered_data.groupby("DATE")[["Sales total", "Cost total"]].sum().reset_index()
+                        time_series_data = sum_by(filtered_data, "DATE", ["Sales total", "Cost total"], scope)
 
                         # Create a line chart for overall trend
                         sales_cost_chart = px.line(
@@ -328,7 +397,7 @@ if uploaded_file:
                         )
                     else:
                         # Group data by DATE and selected category
-                        time_series_data = filtered_data.groupby(["DATE", trend_category])[["Sales total", "Cost total"]].sum().reset_index()
+                        time_series_data = sum_by(filtered_data, ["DATE", trend_category], ["Sales total", "Cost total"], scope)
 
                         # Show all categories by default
                         category_values = time_series_data[trend_category].unique().tolist()
@@ -351,7 +420,7 @@ if uploaded_file:
                         )
 
                         # Create a combined column for unique coloring
-                        melted_data["Category_Metric"] = melted_data[trend_category] + " - " + melted_data["Metric"]
+                        melted_data["Category_Metric"] = melted_data[trend_category].astype(str) + " - " + melted_data["Metric"]
 
                         # Create a line chart with distinct colors for each Category + Metric combination
                         sales_cost_chart = px.line(
@@ -383,7 +452,7 @@ if uploaded_file:
                 client_data = filtered_data[filtered_data['Client level'] == selected_client]
 
                 # Group data by Category and calculate total profit
-                category_profit = client_data.groupby("Category1")["Profit"].sum().reset_index()
+                category_profit = client_data.groupby("Category1", observed=True)["Profit"].sum().reset_index()
 
                 # Create a bar chart
                 profit_bar_chart = px.bar(
@@ -442,18 +511,11 @@ if uploaded_file:
                 # Generate the Chart Based on User Selections
                 if not filtered_data.empty:  # Ensure there is data to display
                     # Group data by selected aggregation_basis and secondary_dimension
-                    aggregated_data = (
-                        filtered_data.groupby([aggregation_basis, secondary_dimension])[numeric_metric]
-                        .sum()
-                        .reset_index()
-                    )
+                    aggregated_data = sum_by(filtered_data, [aggregation_basis, secondary_dimension], numeric_metric, scope)
 
                     if display_option == "Percentage Share":
                         # Calculate percentage share within each aggregation_basis group
-                        aggregated_data["Percentage"] = (
-                            aggregated_data.groupby(aggregation_basis)[numeric_metric]
-                            .transform(lambda x: x / x.sum() * 100)
-                        )
+                        aggregated_data["Percentage"] = share(aggregated_data, numeric_metric, aggregation_basis)
                         y_axis = "Percentage"  # Use percentage column for chart
                         y_label = "Percentage Share (%)"
                         chart_title = f"{numeric_metric} Percentage Share by {aggregation_basis} and {secondary_dimension}"
@@ -685,7 +747,7 @@ if uploaded_file:
 
                     # Generate Stacked Bar Chart
                     st.header(f"Stacked Bar Chart: {categorical1} and {categorical2}")
-                    aggregated_data = filtered_data.groupby([categorical1, categorical2]).size().reset_index(name="Count")
+                    aggregated_data = size_by(filtered_data, [categorical1, categorical2], scope, name="Count")
                     fig = px.bar(
                         aggregated_data,
                         x=categorical1,
@@ -712,7 +774,7 @@ if uploaded_file:
                     if categorical2 == "None":
                         # Generate Grouped Bar Chart
                         st.header(f"Grouped Bar Chart: {numeric_column} by {categorical1}")
-                        aggregated_data = filtered_data.groupby(categorical1)[numeric_column].sum().reset_index()
+                        aggregated_data = sum_by(filtered_data, categorical1, numeric_column, scope)
                         fig = px.bar(
                             aggregated_data,
                             x=categorical1,
@@ -723,7 +785,7 @@ if uploaded_file:
                     else:
                         # Generate Stacked Bar Chart
                         st.header(f"Stacked Bar Chart: {numeric_column} by {categorical1} and {categorical2}")
-                        aggregated_data = filtered_data.groupby([categorical1, categorical2])[numeric_column].sum().reset_index()
+                        aggregated_data = sum_by(filtered_data, [categorical1, categorical2], numeric_column, scope)
                         fig = px.bar(
                             aggregated_data,
                             x=categorical1,
@@ -743,6 +805,8 @@ if uploaded_file:
                 # Create the Business Assessment page
                 def business_assessment():
                     st.title("Business Assessment")
+                    # Every section groups the whole dataset, read off the daily cube where it can
+                    data_scope = cube_scope(data)
 
                     # Section 1: Profitability Analysis
                     st.header("1. Profitability Analysis")
@@ -752,13 +816,13 @@ if uploaded_file:
                     with col2:
                         aggregation = st.selectbox("Aggregate By", options=categorical_columns, index=0)
                     if metric and aggregation:
-                        agg_data = data.groupby(aggregation)[metric].sum().reset_index()
+                        agg_data = sum_by(data, aggregation, metric, data_scope)
                         fig = px.bar(agg_data, x=aggregation, y=metric, color=aggregation, title=f"{metric} by {aggregation}")
                         st.plotly_chart(fig)
 
                     # Section 2: Cost Efficiency
                     st.header("2. Cost Efficiency")
-                    cost_efficiency = data.groupby("Category1")[["Cost total", "Sales total"]].sum().reset_index()
+                    cost_efficiency = sum_by(data, "Category1", ["Cost total", "Sales total"], data_scope)
                     fig2 = px.bar(
                         cost_efficiency,
                         x="Category1",
@@ -771,7 +835,7 @@ if uploaded_file:
 
                     # Section 3: Volume and Weight Analysis
                     st.header("3. Volume and Weight Analysis")
-                    volume_weight = data.groupby("Category1")[["CBM", "WEIGHT"]].sum().reset_index()
+                    volume_weight = sum_by(data, "Category1", ["CBM", "WEIGHT"], data_scope)
                     fig3 = px.scatter(
                         volume_weight,
                         x="CBM",
@@ -785,7 +849,7 @@ if uploaded_file:
 
                     # Section 4: Shipment Trends
                     st.header("4. Shipment Trends")
-                    shipment_trend = data.groupby("DATE")[["Sales total", "Cost total"]].sum().reset_index()
+                    shipment_trend = sum_by(data, "DATE", ["Sales total", "Cost total"], data_scope)
                     fig4 = px.line(
                         shipment_trend,
                         x="DATE",
@@ -797,7 +861,7 @@ if uploaded_file:
 
                     # Section 5: Client Segmentation
                     st.header("5. Client Segmentation")
-                    client_segmentation = data.groupby("Client level")[["Profit", "Sales total"]].sum().reset_index()
+                    client_segmentation = sum_by(data, "Client level", ["Profit", "Sales total"], data_scope)
                     fig5 = px.bar(
                         client_segmentation,
                         x="Client level",
@@ -848,32 +912,30 @@ if uploaded_file:
                 # Step 3: Filter Data for Each Period
                 if not filtered_data.empty:
                     # Filter for Period 1
-                    period_1_data = filtered_data[
-                        (filtered_data['DATE'] >= pd.to_datetime(start_date_1)) &
-                        (filtered_data['DATE'] <= pd.to_datetime(end_date_1))
-                    ]
+                    period_1_data = date_index(data).filter(filtered_data, start_date_1, end_date_1)
                     # Aggregate data for Period 1
-                    period_1_agg = period_1_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+                    period_1_agg = sum_by(period_1_data, aggregation_basis, numeric_metric,
+                                          narrow_scope(scope, start_date_1, end_date_1))
                     period_1_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 1)"}, inplace=True)
 
                     # Filter for Period 2
-                    period_2_data = filtered_data[
-                        (filtered_data['DATE'] >= pd.to_datetime(start_date_2)) &
-                        (filtered_data['DATE'] <= pd.to_datetime(end_date_2))
-                    ]
+                    period_2_data = date_index(data).filter(filtered_data, start_date_2, end_date_2)
                     # Aggregate data for Period 2
-                    period_2_agg = period_2_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+                    period_2_agg = sum_by(period_2_data, aggregation_basis, numeric_metric,
+                                          narrow_scope(scope, start_date_2, end_date_2))
                     period_2_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 2)"}, inplace=True)
 
                     # Step 4: Merge Period 1 and Period 2 Data
-                    comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(0)
+                    comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(
+                        {f"{numeric_metric} (Period 1)": 0, f"{numeric_metric} (Period 2)": 0}
+                    )
 
                     # Calculate Percentage Difference
                     comparison_data["% Difference"] = (
                         (comparison_data[f"{numeric_metric} (Period 2)"] - comparison_data[f"{numeric_metric} (Period 1)"]) /
                         comparison_data[f"{numeric_metric} (Period 1)"].replace(0, np.nan)
                     ) * 100
-                    comparison_data["% Difference"].fillna(0, inplace=True)
+                    comparison_data["% Difference"] = comparison_data["% Difference"].fillna(0)
 
                     # Step 5: Visualize the Comparison
                     st.subheader(f"Comparison of {numeric_metric} by {aggregation_basis}")
@@ -908,6 +970,6 @@ if uploaded_file:
                     st.warning("No data available to generate the comparison. Please adjust your filters.")
 
     except Exception as e:
-        st.error(f"Error reading the Excel file: {e}")
+        st.error(f"Error reading the Excel files: {e}")
 else:
-    st.warning("Please upload an Excel file to start.")
+    st.warning("Please upload at least one Excel file to start.")
@@ -0,0 +1,695 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Sidebar multiselect columns resolved through the bitmap index
+BITMAP_COLUMNS = ['Destination', 'Client code', 'Client level', 'Sales', 'Mark', 'Category1', 'Category2',
+                  'goods tpye', 'Type', 'Loading warehouse']
+
+# Number of dataset versions whose indexes are kept (shared by all sessions)
+MAX_INDEXED_DATASETS = 4
+
+# Largest value-by-value count table kept for a pair of columns; rarer
+# combinations of filters fall back to counting over the selected rows
+COOCCURRENCE_MAX_CELLS = 1000000
+
+# Number of matches a prefix search sends to the widget
+SEARCH_LIMIT = 50
+
+# Upper bound on the memory held by cached filter results (shared by all sessions)
+SELECTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Number of recent cached results of a dataset checked for one that a new
+# filter state only narrows
+REFINE_CANDIDATES = 32
+
+# Largest share of the dataset a cached result may hold to be narrowed row by
+# row; past it, resolving the filters on the indexes is as fast
+REFINE_MAX_SHARE = 0.125
+
+
+class BitmapIndex:
+    """Row bitmaps for every value of the sidebar's categorical columns.
+
+    A value's rows are stored either as a packed bitmap (np.packbits, one
+    bit per row) or, when the value is rare enough for that to be smaller,
+    as a sorted array of row positions. A selection ORs the values picked
+    within a column, ANDs the columns, and only unpacks the final bitmap.
+    """
+
+    def __init__(self, data, columns=BITMAP_COLUMNS):
+        self.n_rows = len(data)
+        self.entries = {}  # column -> {value: packed uint8 bitmap or int32 row positions}
+        for col in columns:
+            if col in data.columns:
+                self.entries[col] = self._build(data[col])
+
+    def _build(self, values):
+        codes, uniques = pd.factorize(values)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        entries = {}
+        for code, value in enumerate(uniques):
+            rows = order[bounds[code]:bounds[code + 1]].astype(np.int32)
+            # Row positions take 4 bytes a row, a bitmap 1/8 byte a row of the dataset
+            if len(rows) * 32 < self.n_rows:
+                entries[value] = rows
+            else:
+                bits = np.zeros(self.n_rows, dtype=bool)
+                bits[rows] = True
+                entries[value] = np.packbits(bits)
+        return entries
+
+    def column_bitmap(self, col, values):
+        """Return the packed bitmap of the rows whose col is any of values."""
+        packed = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        sparse = []
+        for value in values:
+            entry = self.entries[col].get(value)
+            if entry is None:
+                continue
+            if entry.dtype == np.uint8:
+                packed |= entry
+            else:
+                sparse.append(entry)
+        if sparse:
+            bits = np.zeros(self.n_rows, dtype=bool)
+            bits[np.concatenate(sparse)] = True
+            packed |= np.packbits(bits)
+        return packed
+
+    def bitmap(self, filters):
+        """Return the packed bitmap matching filters, or None if nothing is selected.
+
+        filters maps a column to the values picked for it; columns with no
+        values picked do not filter.
+        """
+        result = None
+        for col, values in filters.items():
+            if len(values):
+                packed = self.column_bitmap(col, values)
+                result = packed if result is None else result & packed
+        return result
+
+    def select(self, filters):
+        """Return the sorted positions of the rows matching filters."""
+        packed = self.bitmap(filters)
+        if packed is None:
+            return np.arange(self.n_rows)
+        return np.flatnonzero(np.unpackbits(packed, count=self.n_rows))
+
+
+class SortedIndex:
+    """Permutation sorting the rows by one column, so that any inclusive
+    range of it is a slice of the permutation found by binary search.
+    Missing values sort last and never fall in a range. The column's
+    min, max and quantiles are read off the sorted values.
+    """
+
+    def __init__(self, values):
+        self.n_rows = len(values)
+        self.order = np.argsort(values, kind='stable')
+        self.sorted_values = values[self.order]
+        self.n_valid = self.n_rows - int(np.count_nonzero(pd.isna(values)))
+
+    def _bound(self, value):
+        return value
+
+    def positions(self, low=None, high=None, inclusive="both"):
+        """Return the positions of the rows within [low, high], in sorted order.
+
+        None leaves that side of the range open; inclusive is "both",
+        "left", "right" or "neither", as for Series.between.
+        """
+        lo = 0
+        hi = self.n_valid
+        if low is not None:
+            side = 'left' if inclusive in ("both", "left") else 'right'
+            lo = np.searchsorted(self.sorted_values[:hi], self._bound(low), side)
+        if high is not None:
+            side = 'right' if inclusive in ("both", "right") else 'left'
+            hi = np.searchsorted(self.sorted_values[:hi], self._bound(high), side)
+        return self.order[lo:max(lo, hi)]
+
+    def missing(self):
+        """Return the positions of the rows with no value."""
+        return self.order[self.n_valid:]
+
+    def covers(self, low=None, high=None):
+        """Return True if every row of the dataset is within [low, high]."""
+        return len(self.positions(low, high)) == self.n_rows
+
+    def mask(self, low=None, high=None, inclusive="both"):
+        """Return a boolean array over all rows, True for rows within [low, high]."""
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.positions(low, high, inclusive)] = True
+        return mask
+
+    def bitmap(self, low=None, high=None, inclusive="both"):
+        """Return the packed bitmap of the rows within [low, high]."""
+        return np.packbits(self.mask(low, high, inclusive))
+
+    def filter(self, frame, low=None, high=None):
+        """Return the rows of frame within [low, high].
+
+        frame is the indexed data or a row subset of it that kept the row
+        positions as its index, as the dashboards' filtered data does.
+        """
+        if len(frame) == self.n_rows:
+            return take_rows(frame, np.sort(self.positions(low, high)))
+        return frame[self.mask(low, high)[frame.index.to_numpy()]]
+
+    def min(self):
+        return self.sorted_values[0] if self.n_valid else None
+
+    def max(self):
+        return self.sorted_values[self.n_valid - 1] if self.n_valid else None
+
+    def quantile(self, q):
+        """Return the q-th quantile of the non-missing values (linear interpolation, as pandas)."""
+        if not self.n_valid:
+            return None
+        position = q * (self.n_valid - 1)
+        below = int(np.floor(position))
+        above = min(below + 1, self.n_valid - 1)
+        low, high = self.sorted_values[below], self.sorted_values[above]
+        return low + (high - low) * (position - below)
+
+
+class DateIndex(SortedIndex):
+    """SortedIndex of the DATE column (or another date column); range bounds
+    may be dates, timestamps or strings."""
+
+    def __init__(self, data, col='DATE'):
+        super().__init__(data[col].to_numpy('datetime64[ns]'))
+
+    def _bound(self, value):
+        return np.datetime64(pd.Timestamp(value), 'ns')
+
+    def min(self):
+        return pd.Timestamp(super().min())
+
+    def max(self):
+        return pd.Timestamp(super().max())
+
+    def quantile(self, q):
+        return pd.Timestamp(super().quantile(q))
+
+
+class CooccurrenceIndex:
+    """Row counts of every value of the BITMAP_COLUMNS, alone and in pairs.
+
+    Gives each sidebar filter its options narrowed to the values still
+    present under the filters picked on the other columns. With one other
+    column filtered, the counts are read from the precomputed pair table;
+    with several, they are counted over the rows the BitmapIndex selects.
+    """
+
+    def __init__(self, data, bitmaps, max_cells=COOCCURRENCE_MAX_CELLS):
+        self.bitmaps = bitmaps
+        self.codes = {}  # column -> factorized codes of every row (-1 for missing)
+        self.values = {}  # column -> values, in code order
+        self.lookup = {}  # column -> {value: code}
+        self.totals = {}  # column -> row count of every value
+        for col in bitmaps.entries:
+            codes, uniques = pd.factorize(data[col])
+            self.codes[col] = codes
+            self.values[col] = pd.Index(uniques.tolist(), dtype=object)
+            self.lookup[col] = {value: code for code, value in enumerate(self.values[col])}
+            self.totals[col] = np.bincount(codes[codes >= 0], minlength=len(uniques))
+
+        self.pairs = {}  # (column a, column b) -> counts[value of a, value of b]
+        columns = list(self.codes)
+        for i, a in enumerate(columns):
+            for b in columns[i + 1:]:
+                n_a, n_b = len(self.values[a]), len(self.values[b])
+                if n_a * n_b > max_cells:
+                    continue
+                valid = (self.codes[a] >= 0) & (self.codes[b] >= 0)
+                pair_codes = self.codes[a][valid].astype(np.int64) * n_b + self.codes[b][valid]
+                counts = np.bincount(pair_codes, minlength=n_a * n_b).reshape(n_a, n_b)
+                self.pairs[(a, b)] = counts
+                self.pairs[(b, a)] = counts.T
+
+    def counts(self, col, filters):
+        """Return the row count of each value of col under the filters on the other columns.
+
+        Values that no longer occur are left out; the most frequent come first.
+        """
+        active = {other: values for other, values in filters.items()
+                  if other != col and other in self.codes and len(values)}
+        if not active:
+            counts = self.totals[col]
+        elif len(active) == 1 and (next(iter(active)), col) in self.pairs:
+            other, values = next(iter(active.items()))
+            picked = [self.lookup[other][value] for value in values if value in self.lookup[other]]
+            counts = self.pairs[(other, col)][picked].sum(axis=0)
+        else:
+            codes = self.codes[col][self.bitmaps.select(active)]
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.values[col]))
+        counts = pd.Series(counts, index=self.values[col])
+        return counts[counts > 0].sort_values(ascending=False, kind='stable')
+
+
+class PrefixIndex:
+    """Distinct values of a column sorted by their lowercased text, so that
+    the values starting with a prefix are a slice found by binary search.
+
+    The keys are kept as Python strings (an object array): a fixed-width
+    array would give every value the width of the longest description.
+    """
+
+    def __init__(self, values):
+        codes, uniques = pd.factorize(values)
+        self.codes = codes.astype(np.int32)  # Value code of every row, -1 for missing
+        self.values = pd.Index(uniques.tolist(), dtype=object)
+        totals = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.counts = pd.Series(totals, index=self.values)  # Row count of every value
+        keys = np.array([str(value).lower() for value in self.values], dtype=object)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def counts_in(self, rows):
+        """Return the row count of every value among the rows at positions rows."""
+        codes = self.codes[rows]
+        return pd.Series(np.bincount(codes[codes >= 0], minlength=len(self.values)), index=self.values)
+
+    def search(self, prefix, limit=SEARCH_LIMIT, counts=None):
+        """Return the values starting with prefix (case-insensitive) and their row counts.
+
+        Only the limit most frequent matches are returned, most frequent
+        first. counts, e.g. narrowed by the other filters, replaces the
+        value totals; values it does not count are left out.
+        """
+        prefix = str(prefix).strip().lower()
+        codes = self.order
+        if prefix:
+            lo = np.searchsorted(self.sorted_keys, prefix, 'left')
+            hi = np.searchsorted(self.sorted_keys, prefix + '\U0010ffff', 'left')
+            codes = codes[lo:hi]
+        values = self.values[codes]
+        if counts is None:
+            matches = self.counts.to_numpy()[codes]
+        else:
+            matches = counts.reindex(values, fill_value=0).to_numpy()
+        found = np.flatnonzero(matches > 0)
+        if len(found) > limit:
+            found = found[np.argpartition(-matches[found], limit - 1)[:limit]]
+        found = found[np.argsort(-matches[found], kind='stable')]
+        return pd.Series(matches[found], index=values[found])
+
+
+# (index kind, dataset digest) -> index, least recently used first
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def dataset_index(kind, data, build):
+    """Return an index of data, built once per dataset version.
+
+    Frames without ``attrs["digest"]`` (e.g. edited in the data editor)
+    get a fresh index that is not shared.
+    """
+    digest = data.attrs.get("digest")
+    if digest is None:
+        return build(data)
+    key = (kind, digest)
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    index = build(data)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len({digest for _, digest in _indexes}) > MAX_INDEXED_DATASETS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def bitmap_index(data):
+    """Return the BitmapIndex of a loaded dataset."""
+    return dataset_index("bitmap", data, BitmapIndex)
+
+
+def date_index(data):
+    """Return the DateIndex of a loaded dataset."""
+    return dataset_index("date", data, DateIndex)
+
+
+def range_index(data, col):
+    """Return the SortedIndex of a numeric column of a loaded dataset."""
+    return dataset_index(("range", col), data,
+                          lambda data: SortedIndex(data[col].to_numpy(dtype='float64', na_value=np.nan)))
+
+
+def prefix_index(data, col):
+    """Return the PrefixIndex of a column of a loaded dataset."""
+    return dataset_index(("prefix", col), data, lambda data: PrefixIndex(data[col]))
+
+
+
+# Statistics of one column; counts (distinct values with their row counts, most
+# frequent first) is kept for categorical columns, low/high/quartiles for numeric
+# and date columns
+ColumnStats = namedtuple("ColumnStats", "role dtype nulls distinct counts low high quartiles")
+
+
+def column_role(dtype):
+    """Return the role of a column of the given dtype: "date", "numeric", "categorical" or "other"."""
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "date"
+    if pd.api.types.is_bool_dtype(dtype):
+        return "other"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric"
+    if (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)
+            or isinstance(dtype, pd.CategoricalDtype)):
+        return "categorical"
+    return "other"
+
+
+class ColumnCatalog:
+    """Statistics of every column of a loaded dataset, for the widgets and pages.
+
+    Numeric and date columns are described from their SortedIndex (which the
+    range filters share), other columns from one factorize.
+    """
+
+    def __init__(self, data):
+        self.n_rows = len(data)
+        self.stats = {col: self._describe(data, col) for col in data.columns}
+
+    def _describe(self, data, col):
+        series = data[col]
+        role = column_role(series.dtype)
+        if role in ("numeric", "date"):
+            if role == "numeric":
+                index = range_index(data, col)
+            elif col == 'DATE':
+                index = date_index(data)
+            else:
+                index = DateIndex(data, col)
+            values = index.sorted_values[:index.n_valid]
+            distinct = int(np.count_nonzero(values[1:] != values[:-1])) + 1 if len(values) else 0
+            quartiles = tuple(index.quantile(q) for q in (0.25, 0.5, 0.75))
+            return ColumnStats(role, series.dtype, self.n_rows - index.n_valid, distinct, None,
+                               index.min(), index.max(), quartiles)
+        codes, uniques = pd.factorize(series)
+        counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(uniques)),
+                           index=pd.Index(uniques.tolist(), dtype=object))
+        return ColumnStats(role, series.dtype, int(np.count_nonzero(codes < 0)), len(uniques),
+                           counts.sort_values(ascending=False, kind='stable'), None, None, None)
+
+    def __getitem__(self, col):
+        return self.stats[col]
+
+    def __contains__(self, col):
+        return col in self.stats
+
+    def columns(self, role, frame=None):
+        """Return the columns of frame (default: the dataset) with the given role.
+
+        Columns frame added or retyped after loading get the role of their
+        current dtype.
+        """
+        if frame is None:
+            return [col for col, stats in self.stats.items() if stats.role == role]
+        return [
+            col for col in frame.columns
+            if (self.stats[col].role if col in self.stats and self.stats[col].dtype == frame[col].dtype
+                else column_role(frame[col].dtype)) == role
+        ]
+
+
+def column_catalog(data):
+    """Return the ColumnCatalog of a loaded dataset."""
+    return dataset_index("catalog", data, ColumnCatalog)
+
+
+class SelectionCache:
+    """LRU cache of filter results (row positions), bounded by their size."""
+
+    def __init__(self, max_bytes=SELECTION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (digest, filter key) -> row positions
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refined = 0  # Misses answered by narrowing an earlier result
+
+    def get(self, key):
+        with self._lock:
+            rows = self._entries.get(key)
+            if rows is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def put(self, key, rows):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).nbytes
+            self._entries[key] = rows
+            self._size += rows.nbytes
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def recent(self, digest, limit=REFINE_CANDIDATES):
+        """Return the (filter key, rows) of the most recent results for a dataset version."""
+        with self._lock:
+            entries = [(key[1], rows) for key, rows in reversed(self._entries.items()) if key[0] == digest]
+        return entries[:limit]
+
+    def count_refined(self):
+        with self._lock:
+            self.refined += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refined": self.refined,
+            }
+
+
+# Module-level cache so that every session filtering the same dataset shares results
+selection_cache = SelectionCache()
+
+
+def _normalize_values(values):
+    """Return the values picked in a multiselect in a canonical order."""
+    return tuple(sorted(set(values), key=lambda value: (type(value).__name__, str(value))))
+
+
+def filter_key(filters, date_range=None, ranges=None, query=None):
+    """Return a canonical, hashable form of the sidebar state.
+
+    The order in which values were picked and columns with nothing picked
+    do not matter; dates and range bounds are compared as timestamps and
+    floats, whatever widget produced them. An expression filter is keyed
+    by its compiled plan, so spacing and keyword case do not matter either.
+    """
+    return (
+        tuple(sorted((col, _normalize_values(values)) for col, values in filters.items() if len(values))),
+        None if date_range is None else tuple(pd.Timestamp(value).isoformat() for value in date_range),
+        tuple(sorted((col, float(low), float(high)) for col, (low, high) in (ranges or {}).items())),
+        None if query is None else query.key,
+    )
+
+
+def _evaluate(data, filters, date_range, ranges, query=None):
+    """Return the packed bitmap of the rows matching the sidebar state, or None."""
+    index = bitmap_index(data)
+    packed = index.bitmap({col: values for col, values in filters.items() if col in index.entries})
+    masks = [
+        data[col].isin(values).to_numpy()
+        for col, values in filters.items()
+        if len(values) and col not in index.entries
+    ]
+    bitmaps = [np.packbits(mask) for mask in masks]
+    sorted_ranges = [(range_index(data, col), low, high) for col, (low, high) in (ranges or {}).items()]
+    if date_range is not None:
+        sorted_ranges.append((date_index(data), *date_range))
+    # A range spanning the whole column (the sliders' default) filters nothing
+    bitmaps += [index.bitmap(low, high) for index, low, high in sorted_ranges if not index.covers(low, high)]
+    if query is not None:
+        bitmaps.append(query.bitmap(data))
+    for bitmap in bitmaps:
+        packed = bitmap if packed is None else packed & bitmap
+    return packed
+
+
+def _narrowing(key, previous):
+    """Return what differs between two filter_key states if key only narrows previous, else None.
+
+    key narrows previous when every row it matches also matches previous:
+    each column filtered before keeps a subset of its values, the date and
+    numeric ranges only shrink and the expression filter is unchanged or
+    new. The differences are returned as (changed columns, date range
+    changed, changed range columns, query changed).
+    """
+    filters, dates, ranges, query = key
+    old_filters, old_dates, old_ranges, old_query = previous
+    filters, old_filters = dict(filters), dict(old_filters)
+    if any(col not in filters or not set(filters[col]) <= set(values) for col, values in old_filters.items()):
+        return None
+    if old_dates is not None:
+        if dates is None:
+            return None
+        start, end = (pd.Timestamp(value) for value in dates)
+        old_start, old_end = (pd.Timestamp(value) for value in old_dates)
+        if start < old_start or end > old_end:
+            return None
+    ranges = {col: (low, high) for col, low, high in ranges}
+    old_ranges = {col: (low, high) for col, low, high in old_ranges}
+    for col, (old_low, old_high) in old_ranges.items():
+        if col not in ranges or ranges[col][0] < old_low or ranges[col][1] > old_high:
+            return None
+    if old_query is not None and query != old_query:
+        return None
+    return (
+        [col for col in filters if filters[col] != old_filters.get(col)],
+        dates != old_dates,
+        [col for col in ranges if ranges[col] != old_ranges.get(col)],
+        query != old_query,
+    )
+
+
+def _bits_at(packed, rows):
+    """Return, for each of the row positions rows, whether its bit is set in a packed bitmap."""
+    return (packed[rows >> 3] >> (7 - (rows & 7)).astype(np.uint8)) & 1 == 1
+
+
+def _between(values, low, high):
+    return (values >= low) & (values <= high)
+
+
+def _refine(data, rows, changed, filters, date_range, ranges, query):
+    """Return the rows, among the earlier result rows, that pass the predicates that changed."""
+    columns, dates_changed, range_columns, query_changed = changed
+    index = bitmap_index(data)
+    checks = []
+    for col in columns:
+        if col in index.entries:
+            checks.append(lambda rows, packed=index.column_bitmap(col, filters[col]): _bits_at(packed, rows))
+        else:
+            checks.append(lambda rows, col=col: data[col].iloc[rows].isin(filters[col]).to_numpy())
+    for col in range_columns:
+        checks.append(lambda rows, col=col: _between(
+            data[col].iloc[rows].to_numpy(dtype='float64', na_value=np.nan), *ranges[col]))
+    if dates_changed:
+        start, end = (np.datetime64(pd.Timestamp(value), 'ns') for value in date_range)
+        checks.append(lambda rows: _between(data['DATE'].iloc[rows].to_numpy('datetime64[ns]'), start, end))
+    if query_changed:
+        checks.append(lambda rows: _bits_at(query.bitmap(data), rows))
+    # Each predicate only looks at the rows that passed the previous ones
+    for check in checks:
+        if not len(rows):
+            break
+        rows = rows[check(rows)]
+    return rows
+
+
+def _refine_cached(data, key, filters, date_range, ranges, query, cache):
+    """Return the rows matching key by narrowing the smallest cached result it narrows, or None."""
+    best = None
+    for previous, rows in cache.recent(key[0]):
+        if len(rows) > len(data) * REFINE_MAX_SHARE or (best is not None and len(rows) >= len(best[1])):
+            continue
+        changed = _narrowing(key[1], previous)
+        if changed is not None:
+            best = (changed, rows)
+    if best is None:
+        return None
+    changed, rows = best
+    cache.count_refined()
+    return _refine(data, rows, changed, filters, date_range, ranges, query)
+
+
+def cooccurrence_index(data):
+    """Return the CooccurrenceIndex of a loaded dataset."""
+    return dataset_index("cooccurrence", data, lambda data: CooccurrenceIndex(data, bitmap_index(data)))
+
+
+def cascading_options(data, filters):
+    """Return, for every BITMAP_COLUMNS column, the row count of each value
+    still present under the filters picked on the other columns."""
+    index = cooccurrence_index(data)
+    return {col: index.counts(col, filters) for col in index.codes}
+
+
+def search_counts(data, col, filters):
+    """Return the row count of each value of a prefix-searched column under
+    the filters picked on the other columns, as cascading_options narrows
+    the listed options."""
+    index = prefix_index(data, col)
+    active = {other: values for other, values in filters.items() if other != col and len(values)}
+    if not active:
+        return index.counts
+    return index.counts_in(select_rows(data, active))
+
+
+def select_rows(data, filters, date_range=None, ranges=None, query=None, cache=selection_cache):
+    """Return the sorted positions of the rows matching the sidebar filters.
+
+    filters maps a column to the values picked for it: the BITMAP_COLUMNS
+    are resolved on the BitmapIndex, other columns with isin. date_range,
+    an inclusive (start, end), is resolved on the DateIndex, and ranges
+    maps a numeric column to an inclusive (low, high), resolved on its
+    SortedIndex. query is an optional compiled expression filter
+    (titus_query.compile_query) ANDed with the rest. Results are cached
+    per dataset version and filter_key, and must not be modified.
+
+    A state that only narrows a cached one (a value dropped from a filter,
+    a shorter range, ...) is answered from the cached rows, checking only
+    the predicates that changed.
+    """
+    digest = data.attrs.get("digest")
+    key = (digest, filter_key(filters, date_range, ranges, query))
+    if digest is None:
+        rows = None
+    else:
+        rows = cache.get(key)
+        if rows is not None:
+            return rows
+        rows = _refine_cached(data, key, filters, date_range, ranges, query, cache)
+    if rows is None:
+        packed = _evaluate(data, filters, date_range, ranges, query)
+        if packed is None:
+            rows = np.arange(len(data))
+        else:
+            rows = np.flatnonzero(np.unpackbits(packed, count=len(data)))
+    rows.flags.writeable = False  # Shared between sessions
+    if digest is not None:
+        cache.put(key, rows)
+    return rows
+
+
+def take_rows(data, rows):
+    """Return the rows of data at the sorted positions rows, copying as little as possible.
+
+    All rows, or one contiguous run of them, give a frame that shares the
+    columns of data; any other selection copies only the selected rows,
+    once. The row positions are kept as the index. The shared columns are
+    only safe to modify under Copy-on-Write, the default from pandas 3 on,
+    which the dashboards turn on for older versions (enable_copy_on_write).
+    """
+    if len(rows) == len(data):
+        return data.copy(deep=False)
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return data.iloc[rows[0]:rows[-1] + 1]
+    return data.take(rows)
@@ -0,0 +1,45 @@
+"""Prepare workbooks for the dashboards ahead of time.
+
+Parses each workbook once and writes its typed columnar snapshot and its
+summary tables (row count, date and range extents) to the snapshot
+directory; titus_app2.py then starts from those artifacts instead of the
+xlsx. Meant to be run from the nightly job:
+
+    python titus_ingest.py titus_data.xlsx
+"""
+import argparse
+import sys
+
+from titus_loader import SNAPSHOT_DIR, feather, prepare_workbook, snapshot_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare Titus workbooks for the dashboards.")
+    parser.add_argument("workbooks", nargs="*", default=["titus_data.xlsx"],
+                        help="Excel exports to prepare (default: titus_data.xlsx)")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR,
+                        help=f"where the artifacts are written (default: {SNAPSHOT_DIR})")
+    parser.add_argument("--streaming", action="store_true",
+                        help="read the workbooks in chunks of rows to keep memory low")
+    args = parser.parse_args(argv)
+
+    if feather is None:
+        print("pyarrow is required to write snapshots", file=sys.stderr)
+        return 1
+
+    failed = 0
+    for path in args.workbooks:
+        try:
+            manifest = prepare_workbook(path, args.snapshot_dir, streaming=args.streaming)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        print(f"{path}: {manifest['rows']} rows -> {snapshot_path(manifest['digest'], args.snapshot_dir)}")
+        if manifest["coerced_dates"]:
+            print(f"{path}: {manifest['coerced_dates']} DATE values could not be read as dates")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
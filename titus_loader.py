@@ -0,0 +1,850 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from itertools import islice
+from multiprocessing import get_context
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # Columnar snapshots are skipped when pyarrow is missing
+    pa = None
+    feather = None
+
+# Columns converted to numbers once the header row is promoted
+NUMERIC_COLUMNS = ['Profit', 'Sales total', 'Cost total', 'WEIGHT', 'CBM', 'CTNS']
+
+# Column recording which uploaded workbook each row came from
+SOURCE_COLUMN = 'Source file'
+
+# Older exports spell some headers differently; they are renamed on load
+COLUMN_ALIASES = {'Description in E': 'Description in EN', 'Description in C': 'Description in CN'}
+
+# Low-cardinality text columns, stored as categoricals
+DIMENSION_COLUMNS = ['Destination', 'Client level', 'Type', 'Loading warehouse', 'Category1',
+                     'Category2', 'goods tpye', 'Sales', 'Mark', SOURCE_COLUMN]
+
+# Declarative dtypes of the "Data" sheet. Money stays float64 so that totals
+# keep their cents; physical measures and counts are downcast.
+DATA_SCHEMA = {
+    'DATE': 'datetime64[ns]',
+    'Profit': 'float64',
+    'Sales total': 'float64',
+    'Cost total': 'float64',
+    'WEIGHT': 'float32',
+    'CBM': 'float32',
+    'CTNS': 'Int32',
+    **{col: 'category' for col in DIMENSION_COLUMNS},
+}
+
+# Day zero of Excel date serials (1900 date system, including its leap-year bug)
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+
+# Wide free-text columns. They stay in the snapshot and are only loaded into
+# memory when a view asks for them (see with_columns).
+LAZY_COLUMNS = ['Description in EN', 'Description in CN']
+
+# Columns whose min/max are precomputed by prepare_workbook (dates, range sliders)
+EXTENT_COLUMNS = ['DATE', 'Profit', 'WEIGHT', 'CBM']
+
+# Columns hashed to tell whether a row is new or changed between uploads
+ROW_KEY_COLUMNS = ['Shipment NO.', 'Client code', 'DATE'] + NUMERIC_COLUMNS
+
+# Upper bound on the memory held by parsed workbooks (shared by all sessions)
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Rows coerced at a time by the streaming loader
+STREAM_CHUNK_ROWS = 10000
+
+# Share of a parse_workbook call done once each stage is over, reported to
+# its progress callback. Reading the sheet takes most of the time and reports
+# nothing until it is over (stream_workbook reports it chunk by chunk).
+PARSE_STAGES = {'read': 0.7, 'header': 0.75, 'numbers': 0.8, 'dates': 0.95, 'schema': 1.0}
+
+# Directory holding the Arrow IPC copies of every workbook parsed so far
+SNAPSHOT_DIR = os.environ.get("TITUS_SNAPSHOT_DIR", ".titus_cache")
+
+# Bumped whenever the cleaned frame changes shape, so stale snapshots are ignored
+SNAPSHOT_VERSION = 3
+
+
+def enable_copy_on_write():
+    """Turn on pandas Copy-on-Write, which the dashboards rely on.
+
+    Filtered frames share their columns with the loaded data instead of
+    copying them, so modifying one must not write through to the other.
+    pandas 3 always works this way; older versions need the option on. It
+    changes pandas semantics for the whole process, so only the dashboard
+    scripts call this, once, and the library modules leave it alone.
+    """
+    if int(pd.__version__.split(".")[0]) < 3:
+        pd.set_option("mode.copy_on_write", True)
+
+
+def file_digest(file_bytes):
+    """Return the SHA-256 hex digest that identifies a workbook's content."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def read_file_bytes(source):
+    """Return the raw bytes of an uploaded file or of a path on disk."""
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    with open(source, "rb") as f:
+        return f.read()
+
+
+# Result of parse_dates: the datetime64[ns] array, the format detected for the
+# text dates (reused for the next chunk of the same export) and the number of
+# non-blank values that could not be read and became NaT
+ParsedDates = namedtuple('ParsedDates', ['values', 'date_format', 'coerced'])
+
+
+def _parse_unique_dates(uniques, date_format):
+    """Parse distinct DATE cells: text, Excel serial numbers or datetimes."""
+    parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    is_text = uniques.map(lambda value: isinstance(value, str)).astype(bool)
+    is_serial = uniques.map(
+        lambda value: isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+    ).astype(bool)
+    is_other = ~is_text & ~is_serial
+
+    text = uniques[is_text].str.strip()
+    if (text != '').any():
+        if date_format is None:
+            date_format = guess_datetime_format(text[text != ''].iloc[0])
+        if date_format is not None:
+            parsed[is_text] = pd.to_datetime(text, format=date_format, errors='coerce')
+        # Cells written in another format than the one detected
+        retry = is_text & parsed.isna()
+        if retry.any():
+            parsed[retry] = pd.to_datetime(text[retry[is_text]], format='mixed', errors='coerce')
+
+    serials = pd.to_numeric(uniques[is_serial], errors='coerce').astype(float)
+    serials = serials.where((serials > 0) & (serials < 2958466))  # Up to 9999-12-31
+    parsed[is_serial] = EXCEL_EPOCH + pd.to_timedelta(serials, unit='D')
+
+    if is_other.any():
+        parsed[is_other] = pd.to_datetime(uniques[is_other], errors='coerce')
+    return parsed, date_format
+
+
+def parse_dates(values, date_format=None):
+    """Convert a column of DATE cells to datetime64[ns].
+
+    Only the distinct cells are parsed (a sheet has far fewer dates than
+    rows) and the result is mapped back with their codes. Text dates are
+    parsed with one format, detected from the first of them unless
+    ``date_format`` is given, and only the cells that do not match it fall
+    back to per-element guessing. Numbers are read as Excel date serials.
+    Returns a ParsedDates.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return ParsedDates(values.to_numpy('datetime64[ns]'), date_format, 0)
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    parsed, date_format = _parse_unique_dates(uniques, date_format)
+
+    blank = uniques.map(lambda value: isinstance(value, str) and not value.strip()).astype(bool)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    coerced = int(counts[(parsed.isna() & ~blank).to_numpy()].sum())
+    # Code -1 (missing cells) picks the trailing NaT
+    table = np.append(parsed.to_numpy('datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return ParsedDates(table[codes], date_format, coerced)
+
+
+def _report(progress, stage):
+    if progress:
+        progress(PARSE_STAGES[stage])
+
+
+def apply_schema(data, schema=DATA_SCHEMA, progress=None):
+    """Rename legacy headers and cast the known columns to their schema dtypes.
+
+    Values that cannot be read as numbers or dates become NaN/NaT; the number
+    of DATE cells lost that way is kept in ``attrs["coerced_dates"]``. All
+    casts go through a single ``astype`` call. ``progress`` is told of each
+    PARSE_STAGES stage as it ends.
+    """
+    data = data.rename(columns=COLUMN_ALIASES)
+    numeric = [col for col in NUMERIC_COLUMNS if col in data.columns]
+    data[numeric] = data[numeric].apply(pd.to_numeric, errors='coerce')
+    _report(progress, 'numbers')
+    if 'DATE' in data.columns and not pd.api.types.is_datetime64_any_dtype(data['DATE']):
+        dates = parse_dates(data['DATE'])
+        data['DATE'] = dates.values
+        data.attrs["coerced_dates"] = dates.coerced
+    _report(progress, 'dates')
+
+    dtypes = {col: dtype for col, dtype in schema.items() if col in data.columns}
+    for col, dtype in dtypes.items():
+        # Nullable integers cannot hold fractions; such columns stay floating point
+        if dtype.startswith('Int') and (data[col].dropna() % 1 != 0).any():
+            dtypes[col] = 'float32'
+    data = data.astype(dtypes)
+    _report(progress, 'schema')
+    return data
+
+
+def clean_data_sheet(data, progress=None):
+    """Promote the English header row and apply the "Data" sheet schema."""
+    data.columns = data.iloc[0]  # Set the first row as column names
+    data = data[1:]  # Drop the first row
+    data.reset_index(drop=True, inplace=True)
+    _report(progress, 'header')
+    return apply_schema(data, progress=progress)
+
+
+def parse_workbook(file_bytes, progress=None):
+    """Parse the "Data" sheet of a workbook into a typed DataFrame.
+
+    ``progress`` is called with the share of the parse done as each of the
+    PARSE_STAGES ends.
+    """
+    data = pd.read_excel(BytesIO(file_bytes), sheet_name="Data")
+    _report(progress, 'read')
+    return clean_data_sheet(data, progress=progress)
+
+
+def _allocate_column(name, size):
+    """Return an empty array of the final dtype for one sheet column."""
+    if name == 'DATE':
+        return np.full(size, np.datetime64('NaT'), dtype='datetime64[ns]')
+    if name in NUMERIC_COLUMNS:
+        return np.full(size, np.nan)
+    return np.full(size, None, dtype=object)
+
+
+def _coerce_chunk(columns, header, chunk, start, date_format=None):
+    """Type one chunk of raw rows into the preallocated column arrays.
+
+    Returns the ParsedDates of the DATE column, or None if there is none.
+    """
+    stop = start + len(chunk)
+    dates = None
+    for position, values in enumerate(zip(*chunk)):
+        name = header[position]
+        values = pd.Series(values, dtype=object)
+        if name == 'DATE':
+            dates = parse_dates(values, date_format)
+            values = dates.values
+        elif name in NUMERIC_COLUMNS:
+            values = pd.to_numeric(values, errors='coerce').to_numpy('float64', na_value=np.nan)
+        columns[position][start:stop] = values
+    return dates
+
+
+def stream_workbook(file_bytes, progress=None, chunk_rows=STREAM_CHUNK_ROWS):
+    """Parse the "Data" sheet row by row with openpyxl's read-only iterator.
+
+    DATE and the numeric columns are typed chunk by chunk straight into
+    preallocated arrays, so the peak memory stays close to the size of the
+    final frame instead of an all-object copy of the sheet; the schema is
+    applied once at the end. ``progress`` is called with the fraction
+    of rows read so far. Blank rows are skipped, as pd.read_excel does.
+    """
+    workbook = openpyxl.load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        sheet = workbook["Data"]
+        rows = sheet.iter_rows(values_only=True)
+        next(rows, None)  # Chinese header row
+        header = list(next(rows, ()))
+        while header and header[-1] is None:  # Trailing empty cells, as pd.read_excel trims them
+            header.pop()
+        header = [np.nan if name is None else name for name in header]
+        width = len(header)
+        non_blank = (
+            row[:width] + (None,) * (width - len(row))
+            for row in rows
+            if any(value is not None for value in row)
+        )
+
+        # The sheet dimension gives the row count up front; grow if it was understated
+        total = max((sheet.max_row or 0) - 2, 1)
+        columns = [_allocate_column(name, total) for name in header]
+        count = 0
+        date_format = None
+        coerced_dates = 0
+        while True:
+            chunk = list(islice(non_blank, chunk_rows))
+            if not chunk:
+                break
+            if count + len(chunk) > total:
+                total = 2 * (count + len(chunk))
+                columns = [
+                    np.concatenate([values, _allocate_column(name, total - len(values))])
+                    for name, values in zip(header, columns)
+                ]
+            dates = _coerce_chunk(columns, header, chunk, count, date_format)
+            if dates is not None:
+                date_format = dates.date_format
+                coerced_dates += dates.coerced
+            count += len(chunk)
+            if progress:
+                progress(min(count / total, 1.0))
+    finally:
+        workbook.close()
+
+    if progress:
+        progress(1.0)
+    data = pd.DataFrame({position: values[:count] for position, values in enumerate(columns)})
+    data.columns = header
+    data = apply_schema(data)
+    data.attrs["coerced_dates"] = coerced_dates
+    return data
+
+
+def snapshot_path(digest, snapshot_dir=SNAPSHOT_DIR):
+    """Return the location of the columnar snapshot for a workbook digest."""
+    return os.path.join(snapshot_dir, f"{digest}-v{SNAPSHOT_VERSION}.arrow")
+
+
+def _arrow_safe(data):
+    """Return a copy of data whose mixed-type object columns hold strings."""
+    data = data.copy(deep=False)
+    for col in data.columns[data.dtypes == object]:
+        if pd.api.types.infer_dtype(data[col], skipna=True).startswith("mixed"):
+            data[col] = data[col].where(data[col].isna(), data[col].astype(str))
+    return data
+
+
+def write_snapshot(data, path):
+    """Write data to an uncompressed Arrow IPC file that can be memory-mapped.
+
+    Returns False when the snapshot cannot be written (pyarrow missing,
+    non-text header cells, unwritable directory); the caller then simply
+    keeps working from the parsed frame.
+    """
+    if feather is None or not all(isinstance(col, str) for col in data.columns):
+        return False
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        table = pa.Table.from_pandas(_arrow_safe(data), preserve_index=False)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, path)  # Readers never see a half-written file
+    except (OSError, pa.ArrowException):
+        return False
+    return True
+
+
+def read_snapshot(path, columns=None):
+    """Memory-map a snapshot written by write_snapshot into a DataFrame.
+
+    Every column gets its own block (split_blocks), so numeric columns
+    without missing values stay views of the mapped file instead of being
+    copied into consolidated blocks. The other columns are converted one
+    at a time, and each Arrow buffer is released as soon as its column is
+    converted (self_destruct), so the peak stays near one copy. The
+    mapped columns are read-only. The dashboards modify them only through
+    Copy-on-Write.
+    """
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def snapshot_columns(path):
+    """Return the column names stored in a snapshot without reading its data."""
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+class WorkbookCache:
+    """LRU cache of parsed workbooks (and of their lazily loaded columns),
+    bounded by their total memory usage."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # digest -> (DataFrame, size in bytes)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, digest, data):
+        size = int(np.sum(data.memory_usage(index=True, deep=True)))
+        with self._lock:
+            if digest in self._entries:
+                self._size -= self._entries.pop(digest)[1]
+            self._entries[digest] = (data, size)
+            self._size += size
+            # Evict least recently used workbooks, but always keep the newest one
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Module-level cache so every Streamlit rerun and session reuses parsed workbooks
+workbook_cache = WorkbookCache()
+
+
+# Workbook digests making up each dataset stacked by load_workbooks
+_dataset_parts = {}
+
+# Number of workbooks whose source (upload or path) is remembered, so that a
+# snapshot deleted from disk can be written again (shared by all sessions)
+MAX_REMEMBERED_SOURCES = 8
+
+# Workbook digest -> source it was loaded from, least recently used first
+_sources = OrderedDict()
+_sources_lock = threading.Lock()
+
+
+def _remember_source(digest, source):
+    with _sources_lock:
+        _sources[digest] = source
+        _sources.move_to_end(digest)
+        while len(_sources) > MAX_REMEMBERED_SOURCES:
+            _sources.popitem(last=False)
+
+
+def _lookup(digest, cache, snapshot_dir):
+    """Return an already parsed workbook from the cache or its snapshot.
+
+    The LAZY_COLUMNS are left in the snapshot.
+    """
+    data = cache.get(digest)
+    if data is None:
+        path = snapshot_path(digest, snapshot_dir)
+        if feather is not None and os.path.exists(path):
+            columns = [col for col in snapshot_columns(path) if col not in LAZY_COLUMNS]
+            data = read_snapshot(path, columns=columns)
+            cache.put(digest, data)
+    return data
+
+
+def _store(digest, data, cache, snapshot_dir):
+    """Snapshot a freshly parsed workbook and cache it without its LAZY_COLUMNS.
+
+    The lazy columns are only dropped once they are safely on disk.
+    """
+    if write_snapshot(data, snapshot_path(digest, snapshot_dir)):
+        data = data.drop(columns=[col for col in LAZY_COLUMNS if col in data.columns])
+    cache.put(digest, data)
+    return data
+
+
+def load_workbook(source, cache=workbook_cache, snapshot_dir=SNAPSHOT_DIR,
+                  streaming=False, progress=None):
+    """Return the typed "Data" sheet of an uploaded file or path.
+
+    Lookups go from the in-memory cache to the columnar snapshot on disk,
+    and only a workbook that has never been seen is parsed from xlsx (its
+    snapshot is written right away for later sessions and restarts). With
+    ``streaming`` the parse uses stream_workbook, which keeps memory low;
+    either parser reports to ``progress``. The LAZY_COLUMNS are not loaded; pass the frame
+    to with_columns when a view needs them. The returned frame is a shallow copy, so adding
+    or replacing columns never touches the cached copy, and its
+    ``attrs["digest"]`` identifies the dataset version.
+    """
+    file_bytes = read_file_bytes(source)
+    digest = file_digest(file_bytes)
+    _remember_source(digest, source)
+    data = _lookup(digest, cache, snapshot_dir)
+    if data is None:
+        parser = stream_workbook if streaming else parse_workbook
+        data = parser(file_bytes, progress=progress)
+        data = _store(digest, data, cache, snapshot_dir)
+    data = data.copy(deep=False)
+    data.attrs["digest"] = digest
+    return data
+
+
+def load_workbooks(sources, cache=workbook_cache, snapshot_dir=SNAPSHOT_DIR,
+                   streaming=False, progress=None, max_workers=None):
+    """Return several workbooks stacked into one frame.
+
+    Workbooks that were never seen before are parsed concurrently in a
+    process pool. Every row records its workbook in SOURCE_COLUMN, and
+    ``progress`` is called with the fraction of workbooks ready (or followed
+    through the parse when a single workbook is new). As with
+    load_workbook, ``attrs["digest"]`` identifies the combined dataset.
+    """
+    names = [getattr(source, "name", os.path.basename(str(source))) for source in sources]
+    contents = [read_file_bytes(source) for source in sources]
+    digests = [file_digest(file_bytes) for file_bytes in contents]
+    for digest, source in zip(digests, sources):
+        _remember_source(digest, source)
+
+    frames = {digest: _lookup(digest, cache, snapshot_dir) for digest in digests}
+    pending = {digest: file_bytes for digest, file_bytes in zip(digests, contents) if frames[digest] is None}
+    parser = stream_workbook if streaming else parse_workbook
+    if len(pending) == 1:
+        digest, file_bytes = pending.popitem()
+        frames[digest] = _store(digest, parser(file_bytes, progress=progress), cache, snapshot_dir)
+    elif pending:
+        # Streamlit runs scripts on threads, so workers are spawned rather than forked
+        workers = min(len(pending), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            futures = {pool.submit(parser, file_bytes): digest for digest, file_bytes in pending.items()}
+            for done, future in enumerate(as_completed(futures), start=1):
+                digest = futures[future]
+                frames[digest] = _store(digest, future.result(), cache, snapshot_dir)
+                if progress:
+                    progress(done / len(futures))
+
+    data = pd.concat(
+        [frames[digest].assign(**{SOURCE_COLUMN: name}) for name, digest in zip(names, digests)],
+        ignore_index=True,
+    )
+    data = apply_schema(data)  # Categoricals with different categories concatenate to object
+    data.attrs["coerced_dates"] = sum(frames[digest].attrs.get("coerced_dates", 0) for digest in digests)
+    data.attrs["digest"] = file_digest("\n".join(f"{name}:{digest}" for name, digest in zip(names, digests)).encode())
+    _dataset_parts[data.attrs["digest"]] = digests
+    return data
+
+
+# Worker threads running the background loads of every session
+_load_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="titus-load")
+
+
+class BackgroundLoad:
+    """A load_workbook/load_workbooks call running on a worker thread.
+
+    The dashboards keep it in st.session_state together with the ``key``
+    identifying the upload, so that reruns triggered while it runs wait on
+    the same load instead of starting a new one. ``progress`` follows the
+    loader's progress callback.
+    """
+
+    def __init__(self, key, loader, *args, **kwargs):
+        self.key = key
+        self.progress = 0.0
+        self.future = _load_pool.submit(loader, *args, progress=self._report, **kwargs)
+
+    def _report(self, fraction):
+        self.progress = fraction
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        """Return the loaded frame, or raise the error the load failed with."""
+        return self.future.result()
+
+
+def _restored_snapshot(digest, snapshot_dir):
+    """Return the snapshot path of a parsed workbook, writing the snapshot again if it is gone.
+
+    A snapshot deleted since the workbook was loaded (snapshot directory
+    cleaned, another TITUS_SNAPSHOT_DIR) is rebuilt by parsing the
+    remembered upload or path again. Raises FileNotFoundError when that
+    workbook is not known or no longer has the same content.
+    """
+    path = snapshot_path(digest, snapshot_dir)
+    if os.path.exists(path):
+        return path
+    with _sources_lock:
+        source = _sources.get(digest)
+    file_bytes = None if source is None else read_file_bytes(source)
+    if file_bytes is None or file_digest(file_bytes) != digest:
+        raise FileNotFoundError(f"The snapshot {path} is missing; upload the workbook again")
+    if not write_snapshot(parse_workbook(file_bytes), path):
+        raise FileNotFoundError(f"The snapshot {path} is missing and could not be written again")
+    return path
+
+
+def _lazy_column(digest, col, cache, snapshot_dir):
+    """Return one LAZY_COLUMNS column of a dataset, read from its snapshots."""
+    key = f"{digest}:{col}"
+    values = cache.get(key)
+    if values is None:
+        parts = []
+        for part in _dataset_parts.get(digest, [digest]):
+            path = _restored_snapshot(part, snapshot_dir)
+            if col in snapshot_columns(path):
+                parts.append(read_snapshot(path, columns=[col])[col])
+            else:  # A workbook exported without this column
+                parts.append(pd.Series(None, index=range(feather.read_table(path, memory_map=True).num_rows),
+                                       dtype=object))
+        values = pd.concat(parts, ignore_index=True).rename(col)
+        cache.put(key, values)
+    return values
+
+
+def deferred_columns(data, snapshot_dir=SNAPSHOT_DIR):
+    """Return the LAZY_COLUMNS available for data but not loaded into it."""
+    digest = data.attrs.get("digest")
+    if feather is None or digest is None:
+        return []
+    available = set()
+    for part in _dataset_parts.get(digest, [digest]):
+        path = snapshot_path(part, snapshot_dir)
+        if os.path.exists(path):
+            available.update(snapshot_columns(path))
+        elif part in _sources:  # The snapshot is written again when a column is asked for
+            available.update(LAZY_COLUMNS)
+    return [col for col in LAZY_COLUMNS if col in available and col not in data.columns]
+
+
+def with_columns(data, columns, cache=workbook_cache, snapshot_dir=SNAPSHOT_DIR):
+    """Return data with the requested LAZY_COLUMNS attached.
+
+    data may be any row subset of a loaded dataset that kept its index and
+    ``attrs["digest"]``; the columns are aligned on that index. Other columns
+    and those already present are ignored, so view code can pass whatever
+    column the user picked. A shallow copy is returned when something is
+    attached.
+    """
+    missing = [col for col in columns if col in LAZY_COLUMNS and col not in data.columns]
+    if not missing:
+        return data
+    data = data.copy(deep=False)
+    for col in missing:
+        values = _lazy_column(data.attrs["digest"], col, cache, snapshot_dir)
+        data[col] = values if values.index.equals(data.index) else values.reindex(data.index)
+    return data
+
+
+def summarize(data):
+    """Return the summary tables the dashboards build their widgets from.
+
+    ``extents`` holds the (min, max) of the EXTENT_COLUMNS. The filter
+    options are not summarized: they come from the dataset's indexes.
+    """
+    return {
+        "rows": len(data),
+        "extents": {col: (data[col].min(), data[col].max()) for col in EXTENT_COLUMNS if col in data.columns},
+    }
+
+
+def manifest_path(path, snapshot_dir=SNAPSHOT_DIR):
+    """Return the location of the manifest written by prepare_workbook.
+
+    The name carries a digest of the normalized path, so workbooks with the
+    same name in different folders get their own manifest. A relative path
+    keeps its name when the app and its artifacts move together.
+    """
+    key = hashlib.sha256(os.path.normpath(path).encode()).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f"{os.path.basename(path)}-{key}.json")
+
+
+def _json_value(value):
+    """Convert numpy scalars and timestamps for json.dump."""
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot store {value!r} in a manifest")
+
+
+def write_manifest(path, data, snapshot_dir=SNAPSHOT_DIR):
+    """Write the manifest of a workbook on disk loaded as data, and return it.
+
+    The manifest records the file's size and modification time, its digest
+    and the summarize() tables, so load_prepared can start from the snapshot
+    without reading or hashing the workbook.
+    """
+    stat = os.stat(path)
+    manifest = {
+        "source": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "version": SNAPSHOT_VERSION,
+        "digest": data.attrs["digest"],
+        "coerced_dates": data.attrs.get("coerced_dates", 0),
+        **summarize(data),
+    }
+    target = manifest_path(path, snapshot_dir)
+    os.makedirs(snapshot_dir or ".", exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, default=_json_value)
+    os.replace(tmp_path, target)
+    return manifest
+
+
+def prepare_workbook(path, snapshot_dir=SNAPSHOT_DIR, streaming=False, cache=workbook_cache):
+    """Snapshot a workbook on disk and write its manifest ahead of time."""
+    data = load_workbook(path, cache, snapshot_dir, streaming=streaming)
+    return write_manifest(path, data, snapshot_dir)
+
+
+def read_manifest(path, snapshot_dir=SNAPSHOT_DIR):
+    """Return the manifest of a prepared workbook, or None if it is missing or stale.
+
+    A manifest is stale when the workbook changed on disk since it was
+    prepared, or when it was written for another SNAPSHOT_VERSION. It is
+    still used if only the artifacts were deployed, without the workbook.
+    """
+    try:
+        with open(manifest_path(path, snapshot_dir), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        return None
+    if os.path.exists(path):
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (manifest["size"], manifest["mtime_ns"]):
+            return None
+    if 'DATE' in manifest["extents"]:
+        manifest["extents"]['DATE'] = [pd.Timestamp(value) for value in manifest["extents"]['DATE']]
+    return manifest
+
+
+def load_prepared(path, snapshot_dir=SNAPSHOT_DIR, cache=workbook_cache):
+    """Return a workbook on disk and its summary tables, as (data, summary).
+
+    Starts from the artifacts of prepare_workbook (see titus_ingest.py);
+    without an up-to-date manifest the workbook is loaded and its manifest
+    written on the spot, so the next start is fast.
+    """
+    manifest = read_manifest(path, snapshot_dir)
+    if manifest is not None:
+        _remember_source(manifest["digest"], path)
+    data = None if manifest is None else _lookup(manifest["digest"], cache, snapshot_dir)
+    if data is None:
+        data = load_workbook(path, cache, snapshot_dir)
+        try:
+            manifest = write_manifest(path, data, snapshot_dir)
+        except OSError:  # Read-only deployment: summarize on every start
+            manifest = summarize(data)
+        return data, manifest
+    data = data.copy(deep=False)
+    data.attrs["digest"] = manifest["digest"]
+    return data, manifest
+
+
+# Positions of the rows added (new or changed) in the current version and of
+# the rows of the previous version that are gone
+RowDelta = namedtuple('RowDelta', ['added', 'removed'])
+
+
+def row_hashes(data, columns=ROW_KEY_COLUMNS):
+    """Return one 64-bit hash per row over the given columns present in data."""
+    keys = data[[col for col in dict.fromkeys(columns) if col in data.columns]].copy(deep=False)
+    for col in keys.columns[keys.dtypes == object]:
+        # Mixed ints and strings are stored as strings in snapshots; hash them the same way
+        keys[col] = keys[col].where(keys[col].isna(), keys[col].astype(str))
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def _unmatched(hashes, other):
+    """Return the positions of the rows of hashes left over once each is matched to an equal row of other.
+
+    Rows are compared as multisets: with a hash occurring n times in hashes
+    and m times in other, its occurrences past the m-th are left over.
+    """
+    order = np.argsort(hashes, kind="stable")
+    ordered = hashes[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]]) if len(ordered) else np.array([], dtype=np.intp)
+    run_lengths = np.diff(np.r_[starts, len(ordered)])
+    occurrence = np.empty(len(hashes), dtype=np.intp)
+    occurrence[order] = np.arange(len(ordered)) - np.repeat(starts, run_lengths)
+    other = np.sort(other)
+    matches = np.searchsorted(other, hashes, side="right") - np.searchsorted(other, hashes, side="left")
+    return np.flatnonzero(occurrence >= matches)
+
+
+def diff_rows(previous_hashes, hashes):
+    """Compare two versions of a dataset by their row hashes.
+
+    A changed row shows up once in ``added`` (its new values) and once in
+    ``removed`` (its old values). Duplicated rows are counted: a row
+    appended once more than it was before is added.
+    """
+    return RowDelta(added=_unmatched(hashes, previous_hashes), removed=_unmatched(previous_hashes, hashes))
+
+
+def _value_counts(values):
+    counts = values.value_counts()
+    return counts[counts > 0]
+
+
+class DeltaTracker:
+    """Follows successive uploads of a dataset and keeps the value counts of
+    ``columns`` (the sidebar filter options) up to date from the rows that
+    changed, not from the full data.
+
+    The first upload is counted in full. A re-upload is diffed against the
+    previous one by row hashes, and only the added and removed rows are
+    counted, so refreshing the counts costs time proportional to the delta.
+    The rows are hashed only once a second upload needs the diff. Rows are
+    compared on ROW_KEY_COLUMNS plus ``columns``, so an edit to any tracked
+    value counts as a change.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.digest = None
+        self.data = None
+        self.hashes = None
+        self.version = 0
+        self.last_delta = None
+        self.value_counts = {}
+
+    def _hashes(self, data):
+        return row_hashes(data, ROW_KEY_COLUMNS + list(self.columns))
+
+    def update(self, data):
+        """Register the dataset loaded on this rerun and return its RowDelta.
+
+        Returns None on reruns where the dataset did not change.
+        """
+        digest = data.attrs.get("digest")
+        if digest is not None and digest == self.digest:
+            return None
+        if self.data is None or list(data.columns) != list(self.data.columns):
+            # First upload, or a different export layout: count from scratch
+            delta = RowDelta(added=np.arange(len(data)), removed=np.arange(0 if self.data is None else len(self.data)))
+            self.value_counts = {col: _value_counts(data[col]).sort_values(ascending=False, kind='stable')
+                                 for col in self.columns if col in data.columns}
+            hashes = None
+        else:
+            previous = self._hashes(self.data) if self.hashes is None else self.hashes
+            hashes = self._hashes(data)
+            delta = diff_rows(previous, hashes)
+            for col, counts in self.value_counts.items():
+                counts = counts.add(_value_counts(data[col].iloc[delta.added]), fill_value=0)
+                counts = counts.sub(_value_counts(self.data[col].iloc[delta.removed]), fill_value=0)
+                self.value_counts[col] = counts[counts > 0].astype(int).sort_values(ascending=False, kind='stable')
+        self.digest = digest
+        self.data = data
+        self.hashes = hashes
+        self.version += 1
+        self.last_delta = delta
+        return delta
+
+    def options(self, col):
+        """Return the values currently present in col, most frequent first."""
+        return self.value_counts[col].index.tolist()
+
+    def counts(self, data):
+        """Return the value counts of the tracked columns if data is the dataset last registered, else None."""
+        digest = data.attrs.get("digest")
+        return self.value_counts if digest is not None and digest == self.digest else None
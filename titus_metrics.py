@@ -0,0 +1,616 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from titus_filters import dataset_index, date_index, range_index
+
+# One column of a grouped metrics table: the sum, distinct count or mean of a
+# column of the data, per group
+Measure = namedtuple("Measure", "name column kind")  # kind: "sum", "nunique" or "mean"
+
+# The Main Dashboard's grouped order metrics
+ORDER_MEASURES = (
+    Measure('Total Sales', 'Sales total', 'sum'),
+    Measure('Total Profit', 'Profit', 'sum'),
+    Measure('Total Weight', 'WEIGHT', 'sum'),
+    Measure('Total CBM', 'CBM', 'sum'),
+    Measure('Unique Shipments', 'Shipment NO.', 'nunique'),
+    Measure('Unique Customers', 'Client code', 'nunique'),
+    Measure('Avg Profit/Sales', 'Profit/Sales', 'mean'),
+    Measure('Avg Profit/Weight', 'Profit/Weight', 'mean'),
+    Measure('Avg Profit/CBM', 'Profit/CBM', 'mean'),
+)
+
+# Number of row sets whose prepared measures are kept (shared by all sessions)
+MAX_CACHED_METRICS = 16
+
+# Dimensions and measures of the daily cube: per day and combination of the
+# dimensions, the sums of the measures and the row count
+CUBE_DIMENSIONS = ['DATE', 'Destination', 'Client level', 'Type', 'Category1', 'Category2', 'Loading warehouse',
+                   'Sales']
+CUBE_MEASURES = ['Sales total', 'Cost total', 'Profit', 'WEIGHT', 'CBM']
+
+# Default number of categories the Top-K sections show
+TOP_K = 20
+
+# Largest share of the dataset's rows a numeric range may drop for the daily
+# cube to still answer, by subtracting those rows from their cells
+CUBE_MAX_EXCLUDED_SHARE = 0.05
+
+# HyperLogLog precision of the distinct-count sketches: 2**SKETCH_PRECISION
+# registers per sketch, for a relative standard error of DISTINCT_ERROR
+SKETCH_PRECISION = 12
+DISTINCT_ERROR = 1.04 / np.sqrt(2 ** SKETCH_PRECISION)
+
+# Largest groups-by-values table used to count distinct values per group;
+# beyond it the (group, value) pairs are deduplicated by sorting
+DENSE_DISTINCT_CELLS = 4000000
+
+
+def group_codes(keys):
+    """Factorize group keys as groupby(sort=True, observed=True) orders them.
+
+    Returns the group code of every row (-1 for missing keys) and the group
+    labels, as an Index named after keys.
+    """
+    codes, uniques = pd.factorize(keys, sort=True)
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        # Unobserved categories are dropped, as with observed=True
+        present = np.bincount(codes[codes >= 0], minlength=len(uniques)) > 0
+        remap = np.cumsum(present) - 1
+        codes = np.where(codes >= 0, remap[np.maximum(codes, 0)], -1)
+        uniques = uniques[present]
+    return codes, pd.Index(uniques, name=keys.name)
+
+
+def count_distinct(codes, n_groups, value_codes, n_values):
+    """Return the number of distinct values (codes >= 0) in each of n_groups groups."""
+    valid = (codes >= 0) & (value_codes >= 0)
+    pairs = codes[valid].astype(np.int64) * n_values + value_codes[valid]
+    if n_groups * n_values <= DENSE_DISTINCT_CELLS:
+        seen = np.bincount(pairs, minlength=n_groups * n_values).reshape(n_groups, n_values) > 0
+        return seen.sum(axis=1)
+    return np.bincount(np.unique(pairs) // n_values, minlength=n_groups)
+
+
+def top_k(values, k=TOP_K):
+    """Return the positions of the k largest values, largest first.
+
+    The k are found by partial selection (np.argpartition) and only they are
+    sorted. Ties keep their order and missing values come last, as with
+    sort_values(ascending=False, kind='stable').head(k).
+    """
+    keys = np.asarray(values, dtype=np.float64)
+    keys = np.where(np.isnan(keys), np.inf, -keys)  # Ascending keys, missing values last
+    k = min(k, len(keys))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(keys):
+        threshold = keys[np.argpartition(keys, k - 1)[k - 1]]
+        chosen = np.flatnonzero(keys < threshold)
+        # Of the values tied at the threshold, the first ones make up the k
+        positions = np.concatenate([chosen, np.flatnonzero(keys == threshold)[:k - len(chosen)]])
+    else:
+        positions = np.arange(len(keys))
+    return positions[np.lexsort((positions, keys[positions]))]
+
+
+def top_rows(table, column, k=TOP_K, others=None, remainder=None):
+    """Return the k rows of table with the largest column, largest first, with a fresh index (see top_k).
+
+    With others (a label), one more row holds the rest of the table: its
+    first column is others and column is remainder, by default the sum of
+    the rest of column. remainder may also be a function of the top rows,
+    for measures that do not add up across rows (distinct counts).
+    """
+    positions = top_k(table[column].to_numpy(dtype=np.float64, na_value=np.nan), k)
+    top = table.iloc[positions].reset_index(drop=True)
+    if others is None or len(positions) == len(table):
+        return top
+    if remainder is None:
+        rest = np.ones(len(table), dtype=bool)
+        rest[positions] = False
+        remainder = table[column].to_numpy()[rest].sum()
+    elif callable(remainder):
+        remainder = remainder(top)
+    return pd.concat([top, pd.DataFrame({table.columns[0]: [others], column: [remainder]})], ignore_index=True)
+
+
+def group_totals(table, column, within=None):
+    """Return, for every row of table, the sum of column over its group.
+
+    The groups are the rows with the same within keys (a column or a list of
+    columns); without within, every row gets the grand total. Rows with a
+    missing key get NaN, as groupby(within)[column].transform("sum") leaves
+    them. The totals are computed once with np.bincount.
+    """
+    values = table[column].to_numpy(dtype=np.float64, na_value=np.nan)
+    values = np.where(np.isnan(values), 0.0, values)
+    if within is None:
+        return np.full(len(table), values.sum())
+    within = [within] if isinstance(within, str) else list(within)
+    columns = [group_codes(table[col]) for col in within]
+    missing = np.zeros(len(table), dtype=bool)
+    for codes, _ in columns:
+        missing |= codes < 0
+    groups, first = _combine([(codes, len(labels)) for codes, labels in columns], len(table))
+    totals = np.bincount(groups, weights=values, minlength=len(first))[groups]
+    totals[missing] = np.nan
+    return totals
+
+
+def share(table, column, within=None):
+    """Return column as a percentage of its group total (see group_totals), per row of table.
+
+    within is the parent level of a breakdown or the period to take shares
+    in; without it the shares are of the grand total. Gives
+    groupby(within)[column].transform(lambda x: x / x.sum() * 100) with one
+    vectorized division instead of a Python call per group.
+    """
+    values = table[column].to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return values / group_totals(table, column, within) * 100
+
+
+class GroupedMetrics:
+    """Grouped metrics of one set of rows, for any dimension.
+
+    The measured columns are prepared once (NaN-free sums, value codes for
+    the distinct counts); each dimension's keys are then factorized once and
+    every measure is reduced with np.bincount. Gives the same tables as
+    groupby(dimension, observed=True).agg(...) followed by size(). The value
+    codes of the distinct counts are only computed when a table counts them
+    exactly.
+    """
+
+    def __init__(self, data, measures=ORDER_MEASURES):
+        self.data = data
+        self.measures = measures
+        self._values = {}  # column -> (values with NaN as 0, non-NaN mask, dtype)
+        self._distinct = {}  # column -> (value codes, number of values)
+        for measure in measures:
+            column = data[measure.column]
+            if measure.kind != "nunique" and measure.column not in self._values:
+                values = column.to_numpy(dtype='float64', na_value=np.nan)
+                valid = ~np.isnan(values)
+                self._values[measure.column] = (np.where(valid, values, 0.0), valid, column.dtype)
+        self._tables = {}
+
+    def _value_codes(self, col):
+        if col not in self._distinct:
+            codes, uniques = pd.factorize(self.data[col])
+            self._distinct[col] = (codes, len(uniques))
+        return self._distinct[col]
+
+    def table(self, dimension, keys=None, scope=None):
+        """Return the metrics grouped by dimension, one row per group, plus 'Order Count'.
+
+        keys replaces data[dimension], e.g. for a column attached after the
+        metrics were prepared. With the CubeScope of the filter state the
+        rows were selected with, distinct counts by a cube dimension are
+        estimated from the distinct-count sketches (see DistinctSketch).
+        """
+        approximate = scope is not None and keys is None and scope.answers(self.data, [dimension], distinct=True)
+        if (dimension, approximate) in self._tables:
+            return self._tables[dimension, approximate].copy()
+        codes, labels = group_codes(self.data[dimension] if keys is None else keys)
+        n_groups = len(labels)
+        valid = codes >= 0
+        group = codes[valid]
+        sizes = np.bincount(group, minlength=n_groups)
+        columns = {}
+        for measure in self.measures:
+            if measure.kind == "nunique":
+                if approximate:
+                    columns[measure.name] = scope.distinct(measure.column, [dimension])[measure.column].to_numpy()
+                else:
+                    columns[measure.name] = count_distinct(codes, n_groups, *self._value_codes(measure.column))
+                continue
+            values, present, dtype = self._values[measure.column]
+            sums = np.bincount(group, weights=values[valid], minlength=n_groups)
+            if measure.kind == "sum":
+                # As groupby keeps the column's dtype (booleans are counted as int64)
+                columns[measure.name] = sums.astype(np.int64 if pd.api.types.is_bool_dtype(dtype) else dtype)
+            else:
+                counts = np.bincount(group, weights=present[valid], minlength=n_groups)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    columns[measure.name] = np.where(counts > 0, sums / counts, np.nan)
+        columns['Order Count'] = sizes
+        table = pd.DataFrame(columns, index=labels)
+        self._tables[dimension, approximate] = table
+        return table.copy()
+
+
+# (dataset digest, row fingerprint, measures) -> GroupedMetrics, least recently used first
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+
+
+def row_fingerprint(data):
+    """Return a hash of the row positions data holds, to key results computed from them."""
+    return hashlib.blake2b(np.ascontiguousarray(data.index.to_numpy()).tobytes(), digest_size=16).hexdigest()
+
+
+def grouped_metrics(data, measures=ORDER_MEASURES):
+    """Return the GroupedMetrics of data.
+
+    data is a row subset of a loaded dataset that kept the row positions as
+    its index; the prepared measures and the tables already computed are
+    shared with every later call for the same rows, across reruns and
+    sessions. Frames without ``attrs["digest"]`` are not cached.
+    """
+    digest = data.attrs.get("digest")
+    if digest is None:
+        return GroupedMetrics(data, measures)
+    key = (digest, row_fingerprint(data), tuple(measures))
+    with _metrics_lock:
+        if key in _metrics:
+            _metrics.move_to_end(key)
+            return _metrics[key]
+    metrics = GroupedMetrics(data, measures)
+    with _metrics_lock:
+        _metrics[key] = metrics
+        while len(_metrics) > MAX_CACHED_METRICS:
+            _metrics.popitem(last=False)
+    return metrics
+
+
+def _combine(columns, n_rows):
+    """Number the distinct combinations of codes (the (codes, number of values) pairs of columns).
+
+    Returns the combination of every row, numbered in lexicographic order of
+    the codes (missing values, -1, first), and the first row of each.
+    """
+    keys = np.zeros(n_rows, dtype=np.int64)
+    span = 1
+    for codes, n_values in columns:
+        if span * (n_values + 1) >= 2 ** 62:
+            # Renumber the combinations so far, which keeps their order, before the key overflows
+            keys = np.unique(keys, return_inverse=True)[1].reshape(-1).astype(np.int64)
+            span = int(keys.max()) + 1 if n_rows else 1
+        keys = keys * (n_values + 1) + (codes + 1)
+        span *= n_values + 1
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return inverse.reshape(-1), first
+
+
+class DailyCube:
+    """Sums of the CUBE_MEASURES and row counts of a loaded dataset, per day
+    and combination of the CUBE_DIMENSIONS.
+
+    There are far fewer cells than rows, so a chart grouping by cube
+    dimensions under filters on cube dimensions is answered by reducing the
+    matching cells. The DATE dimension is the day of each row; when every
+    DATE is a day (no time of day), it also stands for DATE itself.
+    """
+
+    def __init__(self, data, dimensions=CUBE_DIMENSIONS, measures=CUBE_MEASURES):
+        dates = data['DATE'] if 'DATE' in data.columns else None
+        if dates is not None and not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = None
+        if dates is not None:
+            known = dates.dropna()
+            self.daily = bool((known == known.dt.normalize()).all())
+        else:
+            self.daily = False
+        self.dimensions = [col for col in dimensions if col in data.columns and (col != 'DATE' or dates is not None)]
+        self.measures = [
+            col for col in measures
+            if col in data.columns and pd.api.types.is_numeric_dtype(data[col])
+            and not pd.api.types.is_bool_dtype(data[col])
+        ]
+        self.labels = {}  # dimension -> values, in groupby order
+        self.lookup = {}  # dimension -> {value: code}
+        row_codes = []
+        for col in self.dimensions:
+            codes, labels = group_codes(dates.dt.normalize() if col == 'DATE' else data[col])
+            self.labels[col] = labels
+            self.lookup[col] = {value: code for code, value in enumerate(labels)}
+            row_codes.append((codes, len(labels)))
+        cells, first = _combine(row_codes, len(data))
+        self.n_cells = len(first)
+        self.row_cells = cells  # The cell of every row, which the distinct-count sketches are built on
+        self.codes = {col: codes[first] for col, (codes, _) in zip(self.dimensions, row_codes)}
+        self.counts = np.bincount(cells, minlength=self.n_cells)
+        self.sums = {}
+        self.dtypes = {}
+        for col in self.measures:
+            values = data[col].to_numpy(dtype='float64', na_value=np.nan)
+            self.sums[col] = np.bincount(cells, weights=np.nan_to_num(values, nan=0.0), minlength=self.n_cells)
+            self.dtypes[col] = data[col].dtype
+        if 'DATE' in self.codes:
+            days = self.labels['DATE'].to_numpy('datetime64[ns]')
+            self.days = np.where(self.codes['DATE'] >= 0, days[np.maximum(self.codes['DATE'], 0)],
+                                 np.datetime64('NaT', 'ns'))
+
+    def cells(self, filters):
+        """Return a boolean array over the cells, True for those matching filters.
+
+        filters maps a cube dimension to the values picked for it, as the
+        sidebar's multiselects do; columns with no values picked do not filter.
+        """
+        mask = np.ones(self.n_cells, dtype=bool)
+        for col, values in filters.items():
+            if len(values):
+                codes = [self.lookup[col][value] for value in values if value in self.lookup[col]]
+                mask &= np.isin(self.codes[col], codes)
+        return mask
+
+    def days_within(self, low=None, high=None):
+        """Return a boolean array over the cells, True for those whose day is within [low, high]."""
+        mask = ~np.isnat(self.days)
+        if low is not None:
+            mask &= self.days >= np.datetime64(pd.Timestamp(low), 'ns')
+        if high is not None:
+            mask &= self.days <= np.datetime64(pd.Timestamp(high), 'ns')
+        return mask
+
+    def groups(self, cells, by):
+        """Group the cells selected by the mask cells by the dimensions by, in groupby order.
+
+        Returns the selected cells, the group of each, the number of groups and
+        the group labels (dimension -> values); cells missing a value of by
+        are left out.
+        """
+        for col in by:
+            cells = cells & (self.codes[col] >= 0)
+        selected = np.flatnonzero(cells)
+        groups, first = _combine([(self.codes[col][selected], len(self.labels[col])) for col in by], len(selected))
+        labels = {col: self.labels[col].take(self.codes[col][selected][first]) for col in by}
+        return selected, groups, len(first), labels
+
+
+def daily_cube(data):
+    """Return the DailyCube of a loaded dataset, built once per dataset version."""
+    return dataset_index("cube", data, DailyCube)
+
+
+def _bit_length(values):
+    """Return the bit length of every value of a uint64 array below 2**32 (0 for 0)."""
+    return np.frexp(values.astype(np.float64))[1]
+
+
+def sketch_positions(hashes, precision=SKETCH_PRECISION):
+    """Return the HyperLogLog register and rank of 64-bit hashes.
+
+    The first precision bits pick the register, the rank is one more than
+    the number of leading zeros of the remaining bits.
+    """
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes << np.uint64(precision)
+    high, low = rest >> np.uint64(32), rest & np.uint64(0xFFFFFFFF)
+    zeros = np.where(high > 0, 32 - _bit_length(high), 64 - _bit_length(low))
+    return registers, (np.minimum(zeros, 64 - precision) + 1).astype(np.uint8)
+
+
+def sketch_estimate(registers):
+    """Return the HyperLogLog estimate of every row of a (sketches, 2**precision) register array."""
+    m = registers.shape[1]
+    estimates = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    # Few distinct values: linear counting on the empty registers is more accurate
+    empty = np.count_nonzero(registers == 0, axis=1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(empty, 1))
+    estimates = np.where((estimates <= 2.5 * m) & (empty > 0), linear, estimates)
+    return np.rint(estimates).astype(np.int64)
+
+
+class DistinctSketch:
+    """HyperLogLog sketches of the distinct values of one column, one per DailyCube cell.
+
+    Sketches merge by taking the maximum of each register, so the distinct
+    count of any set of cells (a filter state, a date range, one group of a
+    grouping) is estimated from the registers of those cells alone, within
+    DISTINCT_ERROR, without hashing the rows again. Values are hashed as
+    text; missing values are not counted, as with nunique().
+    """
+
+    def __init__(self, data, col, cube, precision=SKETCH_PRECISION):
+        self.size = 2 ** precision
+        codes, uniques = pd.factorize(data[col])
+        hashes = pd.util.hash_array(np.asarray(uniques.astype(str), dtype=object))
+        registers, ranks = sketch_positions(hashes, precision)
+        valid = codes >= 0
+        # Highest rank of every (cell, register): sorted keys, ranks in the low 6 bits
+        keys = np.unique((cube.row_cells[valid] * self.size + registers[codes[valid]]) * 64 + ranks[codes[valid]])
+        last = np.append(keys[1:] >> 6 != keys[:-1] >> 6, True)
+        keys = keys[last]
+        self.cells = (keys >> 6 >> precision).astype(np.int32)
+        self.registers = ((keys >> 6) & (self.size - 1)).astype(np.int16)
+        self.ranks = (keys & 63).astype(np.uint8)
+
+    def estimate(self, group_of_cell, n_groups):
+        """Return the distinct count estimate of each of n_groups groups of cells (group -1: left out)."""
+        groups = group_of_cell[self.cells]
+        kept = groups >= 0
+        registers = np.zeros(n_groups * self.size, dtype=np.uint8)
+        np.maximum.at(registers, groups[kept] * self.size + self.registers[kept], self.ranks[kept])
+        return sketch_estimate(registers.reshape(n_groups, self.size))
+
+
+def distinct_sketch(data, col):
+    """Return the DistinctSketch of a column of a loaded dataset, built once per dataset version."""
+    return dataset_index(("sketch", col), data, lambda data: DistinctSketch(data, col, daily_cube(data)))
+
+
+class CubeScope:
+    """The cells of a DailyCube matching one filter state, and their row count.
+
+    excluded holds the sorted positions of the rows of those cells that the
+    filter state drops anyway (outside a numeric range); their sums and
+    counts are subtracted from their cells.
+    """
+
+    def __init__(self, data, cube, cells, excluded=None):
+        self.data = data  # The loaded dataset, whose excluded rows and sketches the scope reads
+        self.cube = cube
+        self.cells = cells
+        self.excluded = np.empty(0, dtype=np.int64) if excluded is None else excluded
+        self.n_rows = int(self.cube.counts[cells].sum()) - len(self.excluded)
+        self._rows = None
+        self._held = None  # Index of the last frame found to hold the rows of the scope
+
+    def rows(self):
+        """Return the sorted positions of the rows of the scope in the loaded dataset."""
+        if self._rows is None:
+            inside = self.cells[self.cube.row_cells]
+            inside[self.excluded] = False
+            self._rows = np.flatnonzero(inside)
+        return self._rows
+
+    def holds(self, frame):
+        """Return True if frame holds exactly the rows of the scope, with their positions as its index.
+
+        A frame cut from another dataset version or from other rows of the
+        same length is refused; the last index that matched is remembered.
+        """
+        if frame.index is self._held:
+            return True
+        if len(frame) != self.n_rows or frame.attrs.get("digest") != self.data.attrs.get("digest"):
+            return False
+        if not np.array_equal(frame.index.to_numpy(), self.rows()):
+            return False
+        self._held = frame.index
+        return True
+
+    def sum(self, by, measures):
+        """Return the sums of measures over the rows of the scope, grouped by the dimensions by.
+
+        Gives the frame groupby(by, observed=True)[measures].sum().reset_index()
+        gives on those rows; measures None gives the row count of each group
+        in a column named "size".
+        """
+        selected, groups, n_groups, columns = self.cube.groups(self.cells, by)
+        group_of_cell = np.full(self.cube.n_cells, -1, dtype=np.int64)
+        group_of_cell[selected] = groups
+        excluded_groups = group_of_cell[self.cube.row_cells[self.excluded]]
+        kept = excluded_groups >= 0
+        excluded_groups = excluded_groups[kept]
+        sizes = (np.bincount(groups, weights=self.cube.counts[selected], minlength=n_groups)
+                 - np.bincount(excluded_groups, minlength=n_groups)).astype(np.int64)
+        if measures is None:
+            columns['size'] = sizes
+        else:
+            for col in [measures] if isinstance(measures, str) else measures:
+                sums = np.bincount(groups, weights=self.cube.sums[col][selected], minlength=n_groups)
+                if len(excluded_groups):
+                    values = self.data[col].iloc[self.excluded[kept]].to_numpy(dtype='float64', na_value=np.nan)
+                    sums -= np.bincount(excluded_groups, weights=np.nan_to_num(values, nan=0.0), minlength=n_groups)
+                columns[col] = sums.astype(self.cube.dtypes[col])  # As groupby keeps the column's dtype
+        # Groups whose rows are all excluded are not in the rows at all
+        return pd.DataFrame(columns)[sizes > 0].reset_index(drop=True)
+
+    def distinct(self, col, by=()):
+        """Return the estimated number of distinct values of col in the scope, grouped by the dimensions by.
+
+        Gives a frame laid out as sum() gives it, the estimates in column
+        col; see DistinctSketch.
+        """
+        selected, groups, n_groups, columns = self.cube.groups(self.cells, by)
+        group_of_cell = np.full(self.cube.n_cells, -1, dtype=np.int64)
+        group_of_cell[selected] = groups
+        columns[col] = distinct_sketch(self.data, col).estimate(group_of_cell, n_groups)
+        return pd.DataFrame(columns)
+
+    def sketches(self, frame):
+        """Return True if distinct counts over frame, the rows of this scope, can be read off the sketches.
+
+        They can only when the scope keeps its cells whole: sketches cannot
+        take rows out.
+        """
+        return not len(self.excluded) and self.holds(frame)
+
+    def answers(self, frame, by, measures=None, distinct=False):
+        """Return True if grouping frame, the rows of this scope, by by can be read off the cube
+        (distinct: read off the sketches)."""
+        if distinct and not self.sketches(frame):
+            return False
+        if measures is not None:
+            measures = [measures] if isinstance(measures, str) else measures
+            if any(col not in self.cube.sums for col in measures):
+                return False
+        if not by or len(set(by)) != len(by) or any(col not in self.cube.codes for col in by):
+            return False
+        if 'DATE' in by and not self.cube.daily:
+            return False
+        # The frame must hold exactly the rows the scope was computed for
+        return self.holds(frame)
+
+
+def cube_scope(data, filters=None, date_range=None, ranges=None, query=None):
+    """Return the CubeScope of a sidebar filter state (as select_rows takes it), or None.
+
+    The daily cube answers states whose filters only pick values of cube
+    dimensions and that have no expression filter; a date range that
+    filters rows needs daily DATE values, and the numeric ranges may drop
+    at most CUBE_MAX_EXCLUDED_SHARE of the rows (e.g. those with no value).
+    Frames without ``attrs["digest"]`` get no scope.
+    """
+    if query is not None or data.attrs.get("digest") is None:
+        return None
+    cube = daily_cube(data)
+    filters = {col: values for col, values in (filters or {}).items() if len(values)}
+    if any(col not in cube.lookup or col == 'DATE' for col in filters):
+        return None
+    cells = cube.cells(filters)
+    if date_range is not None and not date_index(data).covers(*date_range):
+        if not cube.daily:
+            return None
+        cells &= cube.days_within(*date_range)
+    dropped = None
+    for col, (low, high) in (ranges or {}).items():
+        index = range_index(data, col)
+        if not index.covers(low, high):
+            outside = ~index.mask(low, high)
+            dropped = outside if dropped is None else dropped | outside
+    excluded = None
+    if dropped is not None:
+        excluded = np.flatnonzero(dropped)
+        excluded = excluded[cells[cube.row_cells[excluded]]]
+        if len(excluded) > CUBE_MAX_EXCLUDED_SHARE * len(data):
+            return None
+    return CubeScope(data, cube, cells, excluded)
+
+
+def narrow_scope(scope, low=None, high=None):
+    """Return scope narrowed to the days within [low, high], as DateIndex.filter narrows the rows, or None."""
+    if scope is None or not scope.cube.daily:
+        return None
+    cells = scope.cells & scope.cube.days_within(low, high)
+    return CubeScope(scope.data, scope.cube, cells, scope.excluded[cells[scope.cube.row_cells[scope.excluded]]])
+
+
+def sum_by(frame, by, measures, scope=None):
+    """Return frame.groupby(by, observed=True)[measures].sum().reset_index().
+
+    scope is the CubeScope of the filter state frame holds the rows of
+    (cube_scope, narrow_scope); when the cube has by and measures, the sums
+    are read off its cells instead of grouping the rows.
+    """
+    keys = [by] if isinstance(by, str) else list(by)
+    if scope is not None and scope.answers(frame, keys, measures):
+        return scope.sum(keys, measures)
+    return frame.groupby(by, observed=True)[measures].sum().reset_index()
+
+
+def size_by(frame, by, scope=None, name="size"):
+    """Return frame.groupby(by, observed=True).size().reset_index(name=name), from the cube when scope allows."""
+    keys = [by] if isinstance(by, str) else list(by)
+    if scope is not None and scope.answers(frame, keys):
+        return scope.sum(keys, None).rename(columns={'size': name})
+    return frame.groupby(by, observed=True).size().reset_index(name=name)
+
+
+def distinct_count(frame, col, scope=None):
+    """Return the number of distinct values of col in frame, and its relative error.
+
+    With the CubeScope of the filter state frame holds the rows of, the
+    count is estimated from the distinct-count sketches (error
+    DISTINCT_ERROR); otherwise it is frame[col].nunique() (error 0).
+    """
+    if scope is not None and scope.sketches(frame):
+        return int(scope.distinct(col)[col].sum()), DISTINCT_ERROR
+    return frame[col].nunique(), 0.0
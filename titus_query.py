@@ -0,0 +1,327 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from titus_filters import BITMAP_COLUMNS, bitmap_index, date_index, range_index
+
+# Number of distinct expressions whose compiled plans are kept
+MAX_COMPILED_QUERIES = 256
+
+# Plan nodes. They are hashable, so a plan doubles as the cache key of its result.
+Compare = namedtuple("Compare", "column op value")  # op: == != < <= > >=
+In = namedtuple("In", "column values negated")
+Between = namedtuple("Between", "column low high")
+IsNull = namedtuple("IsNull", "column negated")
+And = namedtuple("And", "terms")
+Or = namedtuple("Or", "terms")
+Not = namedtuple("Not", "term")
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<column>`[^`]+`)
+      | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<date>\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2})?)?)
+      | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      | (?P<op>==|!=|<>|<=|>=|=|<|>|\(|\)|,)
+      | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    )''', re.VERBOSE)
+
+_KEYWORDS = {"and", "or", "not", "in", "between", "is", "null"}
+_COMPARISONS = {"==", "!=", "<", "<=", ">", ">="}
+
+
+class QueryError(ValueError):
+    """An expression filter that cannot be parsed or applied to the data."""
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            position += len(text[position:]) - len(text[position:].lstrip())
+            raise QueryError(f"Unexpected character {text[position]!r} at position {position + 1}")
+        kind = match.lastgroup
+        raw = match.group(kind)
+        start = match.start(kind) + 1
+        if kind == "column":
+            value = raw[1:-1]
+        elif kind == "string":
+            value = re.sub(r"\\(.)", r"\1", raw[1:-1])
+        elif kind == "date":
+            try:
+                value = pd.Timestamp(raw)
+            except ValueError:
+                raise QueryError(f"Invalid date {raw!r} at position {start}") from None
+        elif kind == "number":
+            value = float(raw) if any(c in raw for c in ".eE") else int(raw)
+        elif kind == "op":
+            value = {"=": "==", "<>": "!="}.get(raw, raw)
+        elif raw.lower() in _KEYWORDS:
+            kind, value = "keyword", raw.lower()
+        else:
+            kind, value = "column", raw
+        tokens.append((kind, value, start))
+        position = match.end()
+    tokens.append(("end", None, len(text) + 1))
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser of the expression filter language.
+
+    expression := term ("or" term)*
+    term       := factor ("and" factor)*
+    factor     := "not" factor | "(" expression ")" | condition
+    condition  := column ("==" | "!=" | "<" | "<=" | ">" | ">=") literal
+                | column ["not"] "in" "(" literal ("," literal)* ")"
+                | column "between" literal "and" literal
+                | column "is" ["not"] "null"
+    """
+
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.index = 0
+
+    def peek(self):
+        return self.tokens[self.index]
+
+    def take(self, kind, value=None):
+        token = self.peek()
+        if token[0] != kind or (value is not None and token[1] != value):
+            return None
+        self.index += 1
+        return token
+
+    def expect(self, kind, value=None, what=None):
+        token = self.take(kind, value)
+        if token is None:
+            found = self.peek()
+            found = "end of expression" if found[0] == "end" else repr(found[1])
+            raise QueryError(f"Expected {what or (repr(value) if value else kind)} at position {self.peek()[2]}, found {found}")
+        return token
+
+    def parse(self):
+        plan = self.expression()
+        self.expect("end", what="'and', 'or' or end of expression")
+        return plan
+
+    def expression(self):
+        terms = [self.term()]
+        while self.take("keyword", "or"):
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else Or(tuple(terms))
+
+    def term(self):
+        factors = [self.factor()]
+        while self.take("keyword", "and"):
+            factors.append(self.factor())
+        return factors[0] if len(factors) == 1 else And(tuple(factors))
+
+    def factor(self):
+        if self.take("keyword", "not"):
+            return Not(self.factor())
+        if self.take("op", "("):
+            plan = self.expression()
+            self.expect("op", ")")
+            return plan
+        return self.condition()
+
+    def literal(self):
+        token = self.peek()
+        if token[0] not in ("string", "number", "date"):
+            raise QueryError(f"Expected a value at position {token[2]} (quote text values)")
+        self.index += 1
+        return token[1]
+
+    def condition(self):
+        column = self.expect("column", what="a column name")[1]
+        if self.take("keyword", "is"):
+            negated = self.take("keyword", "not") is not None
+            self.expect("keyword", "null")
+            return IsNull(column, negated)
+        negated = self.take("keyword", "not") is not None
+        if negated or self.peek()[:2] == ("keyword", "in"):
+            self.expect("keyword", "in")
+            self.expect("op", "(")
+            values = [self.literal()]
+            while self.take("op", ","):
+                values.append(self.literal())
+            self.expect("op", ")")
+            return In(column, _normalize(values), negated)
+        if self.take("keyword", "between"):
+            low = self.literal()
+            self.expect("keyword", "and")
+            return Between(column, low, self.literal())
+        token = self.peek()
+        if token[0] != "op" or token[1] not in _COMPARISONS:
+            raise QueryError(f"Expected a comparison after {column!r} at position {token[2]}")
+        self.index += 1
+        return Compare(column, token[1], self.literal())
+
+
+def _normalize(values):
+    return tuple(sorted(set(values), key=lambda value: (type(value).__name__, str(value))))
+
+
+def _columns(plan):
+    if isinstance(plan, (And, Or)):
+        return frozenset().union(*(_columns(term) for term in plan.terms))
+    if isinstance(plan, Not):
+        return _columns(plan.term)
+    return frozenset([plan.column])
+
+
+class Query:
+    """A compiled expression filter.
+
+    The plan resolves categorical equality on the BitmapIndex, DATE and
+    numeric comparisons on their SortedIndex, and only falls back to a
+    vectorized pass over the column for anything else.
+    """
+
+    def __init__(self, text, plan):
+        self.text = text
+        self.plan = plan
+        self.key = plan
+        self.columns = _columns(plan)  # Columns the expression reads
+
+    def bitmap(self, data):
+        """Return the packed bitmap of the rows of data matching the expression."""
+        return _bitmap(data, self.plan)
+
+    def __repr__(self):
+        return f"Query({self.text!r})"
+
+
+@lru_cache(maxsize=MAX_COMPILED_QUERIES)
+def compile_query(text):
+    """Return the Query compiled from text, e.g.
+
+        Destination in ("Lagos", "Dubai") and Profit > 500 and DATE >= 2024-06-01
+
+    Column names with spaces or dots go in backticks (`Client code`), text
+    values in quotes; dates are written as YYYY-MM-DD. Raises QueryError.
+    """
+    return Query(text, _Parser(text).parse())
+
+
+def _cost(data, plan):
+    """Rank plan nodes so that the ones answered from an index run first."""
+    if isinstance(plan, (And, Or)):
+        return max(_cost(data, term) for term in plan.terms)
+    if isinstance(plan, Not):
+        return _cost(data, plan.term)
+    if plan.column in BITMAP_COLUMNS or plan.column == 'DATE' or plan.column not in data.columns:
+        return 0
+    return 0 if pd.api.types.is_numeric_dtype(data[plan.column]) else 1
+
+
+def _bitmap(data, plan):
+    n_bytes = (len(data) + 7) // 8
+    if isinstance(plan, And):
+        packed = np.full(n_bytes, 0xFF, dtype=np.uint8)
+        for term in sorted(plan.terms, key=lambda term: _cost(data, term)):
+            packed &= _bitmap(data, term)
+            if not packed.any():  # The remaining terms cannot add rows back
+                break
+        return packed
+    if isinstance(plan, Or):
+        packed = np.zeros(n_bytes, dtype=np.uint8)
+        for term in plan.terms:
+            packed |= _bitmap(data, term)
+        return packed
+    if isinstance(plan, Not):
+        return ~_bitmap(data, plan.term)
+    if plan.column not in data.columns:
+        raise QueryError(f"Unknown column {plan.column!r}")
+    return _condition(data, plan)
+
+
+def _rows_bitmap(n_rows, rows):
+    bits = np.zeros(n_rows, dtype=bool)
+    bits[rows] = True
+    return np.packbits(bits)
+
+
+def _sorted_condition(index, plan, coerce):
+    """Resolve a condition on a SortedIndex; coerce converts a literal to the column's type."""
+    if isinstance(plan, IsNull):
+        rows = index.missing()
+        packed = _rows_bitmap(index.n_rows, rows)
+        return ~packed if plan.negated else packed
+    if isinstance(plan, Between):
+        return index.bitmap(coerce(plan.low), coerce(plan.high))
+    if isinstance(plan, In):
+        rows = [index.positions(coerce(value), coerce(value)) for value in plan.values]
+        packed = _rows_bitmap(index.n_rows, np.concatenate(rows))
+        return ~packed if plan.negated else packed
+    op, value = plan.op, coerce(plan.value)
+    if op == "!=":
+        return ~index.bitmap(value, value)
+    if op == "==":
+        return index.bitmap(value, value)
+    if op in ("<", "<="):
+        return index.bitmap(None, value, "both" if op == "<=" else "neither")
+    return index.bitmap(value, None, "both" if op == ">=" else "neither")
+
+
+def _as_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    raise QueryError(f"{value!r} is not a number")
+
+
+def _as_date(value):
+    if isinstance(value, (int, float)):
+        raise QueryError(f"{value!r} is not a date (write dates as YYYY-MM-DD)")
+    try:
+        return pd.Timestamp(value)
+    except (TypeError, ValueError):
+        raise QueryError(f"{value!r} is not a date") from None
+
+
+def _candidates(values):
+    """Return the values a literal may be stored as in a text column (1001 or "1001")."""
+    candidates = set(values)
+    for value in values:
+        if isinstance(value, (int, float)):
+            candidates.add(str(int(value)) if float(value).is_integer() else str(value))
+    return candidates
+
+
+def _condition(data, plan):
+    col = plan.column
+    if col == 'DATE' and pd.api.types.is_datetime64_any_dtype(data[col]):
+        return _sorted_condition(date_index(data), plan, _as_date)
+    if pd.api.types.is_numeric_dtype(data[col]) and not pd.api.types.is_bool_dtype(data[col]):
+        return _sorted_condition(range_index(data, col), plan, _as_number)
+    bitmaps = bitmap_index(data)
+    if col in bitmaps.entries and isinstance(plan, (Compare, In)) and getattr(plan, "op", "==") in ("==", "!="):
+        values = plan.values if isinstance(plan, In) else (plan.value,)
+        packed = bitmaps.column_bitmap(col, _candidates(values))
+        negated = plan.negated if isinstance(plan, In) else plan.op == "!="
+        return ~packed if negated else packed
+
+    series = data[col]
+    try:
+        if isinstance(plan, IsNull):
+            mask = series.notna() if plan.negated else series.isna()
+        elif isinstance(plan, In):
+            mask = series.isin(_candidates(plan.values))
+            mask = ~mask if plan.negated else mask
+        elif isinstance(plan, Between):
+            mask = series.between(plan.low, plan.high)
+        elif plan.op in ("==", "!="):
+            mask = series.isin(_candidates((plan.value,)))
+            mask = ~mask if plan.op == "!=" else mask
+        else:
+            mask = {"<": series.lt, "<=": series.le, ">": series.gt, ">=": series.ge}[plan.op](plan.value)
+    except TypeError:
+        raise QueryError(f"Cannot compare {col!r} with the values given") from None
+    return np.packbits(mask.to_numpy(dtype=bool, na_value=False))
@@ -6,6 +6,16 @@ from io import BytesIO
 from fpdf import FPDF
 import numpy as np
 
+from titus_filters import (BITMAP_COLUMNS, cascading_options, column_catalog, date_index, prefix_index,
+                           search_counts, select_rows, selection_cache, take_rows)
+from titus_loader import (BackgroundLoad, DeltaTracker, deferred_columns, enable_copy_on_write, file_digest,
+                          load_workbook, with_columns)
+from titus_metrics import (DISTINCT_ERROR, TOP_K, cube_scope, distinct_count, grouped_metrics, group_totals,
+                           narrow_scope, share, size_by, sum_by, top_rows)
+from titus_query import QueryError, compile_query
+
+enable_copy_on_write()
+
 # Set page configuration
 st.set_page_config(
     page_title="Titus App",  # Title of the web tab
@@ -14,27 +24,78 @@ st.set_page_config(
     initial_sidebar_state="expanded"  # Optional: "expanded" or "collapsed"
 )
 
+# Load the logo
+logo_path = "titus_logo.jpg"
+logo = Image.open(logo_path)
 
 # Step 1: File Upload Section
 st.header("Upload Your Excel File")
 uploaded_file = st.file_uploader("Choose an Excel file", type=["xlsx"])
+streaming_load = st.checkbox(
+    "Low-memory loading",
+    help="Read the workbook in chunks of rows. Use it for year-long exports that run out of memory."
+)
 
 if uploaded_file:
     # Read the uploaded Excel file
     try:
-        data = pd.read_excel(uploaded_file, sheet_name="Data")
-        data.columns = data.iloc[0]  # Set the first row as column names
-        data = data[1:]  # Drop the first row
-        data.reset_index(drop=True, inplace=True)
-        data['DATE'] = pd.to_datetime(data['DATE'], errors='coerce')
-        # Min/max dates
-        min_date = data['DATE'].min()
-        max_date = data['DATE'].max()
+        # Parsed and typed once per file content, then served from the cache.
+        # The description columns stay on disk until a view needs them.
+        # The parse runs on a worker thread; reruns pick up the same load.
+        load_key = (file_digest(uploaded_file.getvalue()), streaming_load)
+        if "load_job" not in st.session_state or st.session_state.load_job.key != load_key:
+            st.session_state.load_job = BackgroundLoad(load_key, load_workbook, uploaded_file,
+                                                       streaming=streaming_load)
+        load_job = st.session_state.load_job
+
+        if not load_job.done():
+            # Skeleton of the sidebar and KPI header, shown until the data is ready
+            with st.sidebar:
+                st.title("Titus Logistics")
+                st.image(logo, width=100)
+                st.markdown("---")
+                st.caption("Filters will appear once the workbook is read.")
+
+            @st.fragment(run_every=0.5)
+            def load_progress():
+                # Only this fragment polls the load; the page reruns once the data is ready
+                if load_job.done():
+                    st.rerun()
+                if load_job.progress:
+                    st.progress(load_job.progress, text="Reading workbook...")
+                else:
+                    # Nothing to measure until the sheet is read, unless it is read in chunks
+                    st.caption("⏳ Reading the sheet...")
+
+            load_progress()
+            st.header("Profit Analysis with Key Metrics")
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric(label="💰 Total Sales", value="…")
+            col2.metric(label="⚖️ Total Weight", value="…")
+            col3.metric(label="💹 Total Profit", value="…")
+            col4.metric(label="📐 Total CBM", value="…")
+            st.stop()
+
+        data = load_job.result()
+        if data.attrs.get("coerced_dates"):
+            st.warning(f"{data.attrs['coerced_dates']} DATE values could not be read as dates and were left empty.")
+
+        # Follow re-uploads and report the rows that changed since the previous one
+        filter_columns = ['Destination', 'Shipment NO.', 'Loading warehouse', 'Client code', 'Client level',
+                          'Sales', 'Mark', 'Category1', 'Category2', 'goods tpye', 'Type']
+        if "delta_tracker" not in st.session_state:
+            st.session_state.delta_tracker = DeltaTracker(filter_columns)
+        delta_tracker = st.session_state.delta_tracker
+        delta = delta_tracker.update(data)
+        if delta is not None and delta_tracker.version > 1:
+            st.info(f"{len(delta.added)} new or changed rows since the previous upload "
+                    f"({len(delta.removed)} rows replaced or removed).")
+        # Column statistics (value counts, extents, quartiles, roles), computed once per dataset
+        catalog = column_catalog(data)
 
-        # Convert numeric columns
-        numeric_columns = ['Profit', 'Sales total', 'Cost total', 'WEIGHT', 'CBM', 'CTNS']
-        for col in numeric_columns:
-            data[col] = pd.to_numeric(data[col], errors='coerce')
+        # Min/max dates
+        min_date = catalog['DATE'].low
+        max_date = catalog['DATE'].high
 
 
 
@@ -52,11 +113,6 @@ if uploaded_file:
     except Exception as e:
         st.error(f"Error reading the Excel file: {e}")
 
-# Load the logo
-logo_path = "titus_logo.jpg"
-logo = Image.open(logo_path)
-
-
 
 
 if uploaded_file:
@@ -103,52 +159,104 @@ if uploaded_file:
             else:
                 date_range = (min_date, max_date)
 
+        # Filter options list the values still present under the other filters, with
+        # their row counts; values already picked always stay listed. Until a filter is
+        # picked they are the counts the delta tracker keeps up to date across uploads.
+        picked = {col: st.session_state.get(f"filter {col}", []) for col in BITMAP_COLUMNS}
+        option_counts = None if any(map(len, picked.values())) else delta_tracker.counts(data)
+        if option_counts is None:
+            option_counts = cascading_options(data, picked)
+
+        def filter_multiselect(label, col):
+            counts = option_counts[col]
+            options = counts.index.tolist() + [value for value in picked[col] if value not in counts.index]
+            return st.multiselect(label, options=options, key=f"filter {col}",
+                                  format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
+        # Columns with too many values to list are searched by prefix on the server; only the
+        # best matches and the values already picked are sent to the widget, counted under
+        # the filters picked on the other columns
+        def search_multiselect(label, col, counts=None):
+            index = prefix_index(data, col)
+            counts = search_counts(data, col, picked) if counts is None else counts
+            prefix = st.text_input(label, key=f"search {col}", placeholder="Type the first characters to search")
+            matches = index.search(prefix, counts=counts)
+            selected = st.session_state.get(f"filter {col}", [])
+            options = matches.index.tolist() + [value for value in selected if value not in matches.index]
+            return st.multiselect(label, options=options, key=f"filter {col}", label_visibility="collapsed",
+                                  format_func=lambda value: f"{value} ({counts.get(value, 0)})")
+
         # Destination Filter
         with st.expander("Destination Filters"):
-            destination = st.multiselect("Select Destination", options=data['Destination'].unique())
+            destination = filter_multiselect("Select Destination", 'Destination')
 
         # Shipment Filters
         with st.expander("Shipment Filters"):
-            shipment_number = st.multiselect("Select Shipment Number", options=data['Shipment NO.'].unique())
-            warehouse = st.multiselect("Select Loading Warehouse", options=data['Loading warehouse'].unique())
+            shipment_number = search_multiselect("Select Shipment Number", 'Shipment NO.')
+            warehouse = filter_multiselect("Select Loading Warehouse", 'Loading warehouse')
 
         # Client Filters
         with st.expander("Client Filters"):
-            client_code = st.multiselect("Select Client Code", options=data['Client code'].unique())
-            client_level = st.multiselect("Select Client Level", options=data['Client level'].unique())
+            client_code = search_multiselect("Select Client Code", 'Client code', option_counts['Client code'])
+            client_level = filter_multiselect("Select Client Level", 'Client level')
 
         # Sales and Goods Filters
         with st.expander("Sales and Goods Filters"):
-            salesperson = st.multiselect("Select Salesperson", options=data['Sales'].unique())
-            mark = st.multiselect("Select Mark (Label)", options=data['Mark'].unique())
-            category1 = st.multiselect("Select Main Category", options=data['Category1'].unique())
-            category2 = st.multiselect("Select Subcategory", options=data['Category2'].unique())
-            description = st.multiselect("Select Description", options=data['Description in EN'].unique())
-            goods_type = st.multiselect("Select Goods Type", options=data['goods tpye'].unique())
+            salesperson = filter_multiselect("Select Salesperson", 'Sales')
+            mark = filter_multiselect("Select Mark (Label)", 'Mark')
+            category1 = filter_multiselect("Select Main Category", 'Category1')
+            category2 = filter_multiselect("Select Subcategory", 'Category2')
+            description = []
+            if st.checkbox("Filter by Description"):
+                try:
+                    data = with_columns(data, ['Description in EN'])
+                    description = search_multiselect("Select Description", 'Description in EN')
+                except FileNotFoundError as error:
+                    st.warning(f"Descriptions are unavailable: {error}")
+            goods_type = filter_multiselect("Select Goods Type", 'goods tpye')
 
         # Transport Type Filter
         with st.expander("Transport Filters"):
-            transport_type = st.multiselect("Select Transport Type", options=data['Type'].unique())
+            transport_type = filter_multiselect("Select Transport Type", 'Type')
 
         # Range Filters for Profit, Weight, and CBM
         with st.expander("Range Filters"):
+            profit_stats = catalog['Profit']
+            weight_stats = catalog['WEIGHT']
+            cbm_stats = catalog['CBM']
+
+            def quartiles(stats):
+                return "Quartiles: " + " / ".join(f"{value:,.2f}" for value in stats.quartiles)
+
             profit_range = st.slider(
                 "Profit Range",
-                min_value=int(data['Profit'].min()),
-                max_value=int(data['Profit'].max()),
-                value=(int(data['Profit'].min()), int(data['Profit'].max()))
+                min_value=int(profit_stats.low),
+                max_value=int(profit_stats.high),
+                value=(int(profit_stats.low), int(profit_stats.high)),
+                help=quartiles(profit_stats)
             )
             weight_range = st.slider(
                 "Weight Range",
-                min_value=int(data['WEIGHT'].min()),
-                max_value=int(data['WEIGHT'].max()),
-                value=(int(data['WEIGHT'].min()), int(data['WEIGHT'].max()))
+                min_value=int(weight_stats.low),
+                max_value=int(weight_stats.high),
+                value=(int(weight_stats.low), int(weight_stats.high)),
+                help=quartiles(weight_stats)
             )
             cbm_range = st.slider(
                 "CBM Range",
-                min_value=float(data['CBM'].min()),
-                max_value=float(data['CBM'].max()),
-                value=(float(data['CBM'].min()), float(data['CBM'].max()))
+                min_value=float(cbm_stats.low),
+                max_value=float(cbm_stats.high),
+                value=(float(cbm_stats.low), float(cbm_stats.high)),
+                help=quartiles(cbm_stats)
+            )
+
+        # Expression Filter
+        with st.expander("Expression Filter"):
+            query_text = st.text_input(
+                "Filter expression",
+                placeholder='Destination in ("Lagos", "Dubai") and Profit > 500 and DATE >= 2024-06-01',
+                help="Combine conditions on any column with and / or / not. Quote text values, write dates "
+                     "as YYYY-MM-DD and put column names with spaces in backticks, e.g. `Client code` = \"C001\"."
             )
 
         # Filter Button
@@ -157,83 +265,37 @@ if uploaded_file:
 
     # Apply Filters
     if st.session_state.filters_applied:
-        filtered_data = data.copy()
-
-        # Date Range Filter
-        filtered_data = filtered_data[
-            (filtered_data['DATE'] >= pd.to_datetime(date_range[0])) &
-            (filtered_data['DATE'] <= pd.to_datetime(date_range[1]))
-        ]
-
-        # Destination Filter
-        if destination:
-            filtered_data = filtered_data[filtered_data['Destination'].isin(destination)]
-
-        # Shipment Number Filter
-        if shipment_number:
-            filtered_data = filtered_data[filtered_data['Shipment NO.'].isin(shipment_number)]
-
-        # Loading Warehouse Filter
-        if warehouse:
-            filtered_data = filtered_data[filtered_data['Loading warehouse'].isin(warehouse)]
-
-        # Client Code Filter
-        if client_code:
-            filtered_data = filtered_data[filtered_data['Client code'].isin(client_code)]
-
-        # Client Level Filter
-        if client_level:
-            filtered_data = filtered_data[filtered_data['Client level'].isin(client_level)]
-
-        # Salesperson Filter
-        if salesperson:
-            filtered_data = filtered_data[filtered_data['Sales'].isin(salesperson)]
-
-        # Mark Filter
-        if mark:
-            filtered_data = filtered_data[filtered_data['Mark'].isin(mark)]
-
-        # Main Category Filter
-        if category1:
-            filtered_data = filtered_data[filtered_data['Category1'].isin(category1)]
-
-        # Subcategory Filter
-        if category2:
-            filtered_data = filtered_data[filtered_data['Category2'].isin(category2)]
-
-        # Description Filter
-        if description:
-            filtered_data = filtered_data[filtered_data['Description in EN'].isin(description)]
-
-        # Goods Type Filter
-        if goods_type:
-            filtered_data = filtered_data[filtered_data['goods tpye'].isin(goods_type)]
-
-        # Transport Type Filter
-        if transport_type:
-            filtered_data = filtered_data[filtered_data['Type'].isin(transport_type)]
-
-        # Profit Range Filter
-        filtered_data = filtered_data[
-            (filtered_data['Profit'] >= profit_range[0]) &
-            (filtered_data['Profit'] <= profit_range[1])
-        ]
-
-        # Weight Range Filter
-        filtered_data = filtered_data[
-            (filtered_data['WEIGHT'] >= weight_range[0]) &
-            (filtered_data['WEIGHT'] <= weight_range[1])
-        ]
-
-        # CBM Range Filter
-        filtered_data = filtered_data[
-            (filtered_data['CBM'] >= cbm_range[0]) &
-            (filtered_data['CBM'] <= cbm_range[1])
-        ]
+        # Every filter is resolved on the shared indexes of the dataset and the matching
+        # rows are taken once, without copying the shared columns; results are cached
+        # per filter state
+        filters = {
+            'Destination': destination, 'Shipment NO.': shipment_number, 'Loading warehouse': warehouse,
+            'Client code': client_code, 'Client level': client_level, 'Sales': salesperson, 'Mark': mark,
+            'Category1': category1, 'Category2': category2, 'Description in EN': description,
+            'goods tpye': goods_type, 'Type': transport_type,
+        }
+        ranges = {'Profit': profit_range, 'WEIGHT': weight_range, 'CBM': cbm_range}
+        dates = (date_range[0], date_range[1])
+        try:
+            query = compile_query(query_text) if query_text.strip() else None
+            # The expression may read description columns that are only loaded on demand
+            query_data = data if query is None else with_columns(data, query.columns)
+            rows = select_rows(query_data, filters, dates, ranges, query)
+        except QueryError as error:
+            st.sidebar.error(f"Expression ignored: {error}")
+            query = None
+            rows = select_rows(data, filters, dates, ranges)
+        filtered_data = take_rows(data, rows)
+        # Charts grouped by cube dimensions are read off the daily cube when the filters allow it
+        scope = cube_scope(data, filters, dates, ranges, query)
 
         st.success(f"Filtered Data: {len(filtered_data)} records found!")
+        cache_stats = selection_cache.stats()
+        st.sidebar.caption(f"Filter cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                           f"({cache_stats['refined']} refined from an earlier result)")
     else:
-        filtered_data = data.copy()
+        filtered_data = data.copy(deep=False)  # Shares the columns of data until they are modified
+        scope = cube_scope(data)
 
     # Display Filtered Data
     #st.subheader("Filtered Data")
@@ -315,20 +377,24 @@ if uploaded_file:
         start_date= "x"
         end_date="y"
 
-        # Filter data based on the selected time period
+        # Filter data based on the selected time period (binary search on the DATE index)
         if time_period != "All Data":
             if time_period == "Last 7 Days":
                 start_date = today - pd.Timedelta(days=7)
-                filtered_data = filtered_data[filtered_data['DATE'] >= start_date]
+                filtered_data = date_index(data).filter(filtered_data, start_date)
+                scope = narrow_scope(scope, start_date)
             elif time_period == "Last 30 Days":
                 start_date = today - pd.Timedelta(days=30)
-                filtered_data = filtered_data[filtered_data['DATE'] >= start_date]
+                filtered_data = date_index(data).filter(filtered_data, start_date)
+                scope = narrow_scope(scope, start_date)
             elif time_period == "Month to Date":
                 start_date = today.replace(day=1)  # First day of the current month
-                filtered_data = filtered_data[filtered_data['DATE'] >= start_date]
+                filtered_data = date_index(data).filter(filtered_data, start_date)
+                scope = narrow_scope(scope, start_date)
             elif time_period == "Year to Date":
                 start_date = today.replace(month=1, day=1)  # First day of the current year
-                filtered_data = filtered_data[filtered_data['DATE'] >= start_date]
+                filtered_data = date_index(data).filter(filtered_data, start_date)
+                scope = narrow_scope(scope, start_date)
             elif time_period == "Custom Date Range":
                 # Custom date range picker
                 custom_date_range = st.date_input(
@@ -337,10 +403,8 @@ if uploaded_file:
                 )
                 if len(custom_date_range) == 2:
                     start_date, end_date = custom_date_range
-                    filtered_data = filtered_data[
-                        (filtered_data['DATE'] >= pd.to_datetime(start_date)) &
-                        (filtered_data['DATE'] <= pd.to_datetime(end_date))
-                    ]
+                    filtered_data = date_index(data).filter(filtered_data, start_date, end_date)
+                    scope = narrow_scope(scope, start_date, end_date)
 
         # Step 2: Display Key Metrics
 
@@ -364,21 +428,36 @@ if uploaded_file:
             # Use pd.concat to append the totals row
             return pd.concat([grouped_data, totals_row_df], axis=0)
 
+        # Function to show a distinct count, with its error bound when it is estimated
+        def format_count(count, error):
+            return f"{count}" if not error else f"≈{count:,} (±{error:.1%})"
+
         # Step 2: Display Key Metrics
         #st.header("Profit Analysis with Key Metrics")
 
+        # Unique counts estimated from the distinct-count sketches of the daily cube
+        # instead of counted over the rows
+        approximate_counts = st.checkbox(
+            "Approximate unique counts (faster on large datasets)",
+            value=False,
+            help=f"HyperLogLog estimates, within ±{DISTINCT_ERROR:.1%} (one standard error); "
+                 "missing shipment numbers are not counted. Used when the filters only "
+                 "pick values of the daily cube's columns and the ranges drop no rows."
+        )
+        sketch_scope = scope if approximate_counts else None
+
         if not filtered_data.empty:
             # Handle invalid values for averages
-            filtered_data['Profit/Sales'].replace([np.inf, -np.inf], np.nan, inplace=True)
-            filtered_data['Profit/Weight'].replace([np.inf, -np.inf], np.nan, inplace=True)
-            filtered_data['Profit/CBM'].replace([np.inf, -np.inf], np.nan, inplace=True)
+            filtered_data['Profit/Sales'] = filtered_data['Profit/Sales'].replace([np.inf, -np.inf], np.nan)
+            filtered_data['Profit/Weight'] = filtered_data['Profit/Weight'].replace([np.inf, -np.inf], np.nan)
+            filtered_data['Profit/CBM'] = filtered_data['Profit/CBM'].replace([np.inf, -np.inf], np.nan)
 
             valid_data = filtered_data.dropna(subset=['Profit/Sales', 'Profit/Weight', 'Profit/CBM'])
 
             # Calculate Key Metrics
             orders_count = len(filtered_data)
-            unique_shipments = filtered_data['Shipment NO.'].nunique()
-            unique_customers = filtered_data['Client code'].nunique()
+            unique_shipments = distinct_count(filtered_data, 'Shipment NO.', sketch_scope)
+            unique_customers = distinct_count(filtered_data, 'Client code', sketch_scope)
             total_sales = filtered_data['Sales total'].sum()
             total_weight = filtered_data['WEIGHT'].sum()
             total_profit = filtered_data['Profit'].sum()
@@ -397,8 +476,8 @@ if uploaded_file:
 
             col1, col2, col3 = st.columns(3)
             col1.metric(label="📦 Orders", value=f"{orders_count}")
-            col2.metric(label="🚚 Unique Shipments", value=f"{unique_shipments}")
-            col3.metric(label="👥 Unique Customers", value=f"{unique_customers}")
+            col2.metric(label="🚚 Unique Shipments", value=format_count(*unique_shipments))
+            col3.metric(label="👥 Unique Customers", value=format_count(*unique_customers))
 
             col1, col2, col3, col4 = st.columns(4)
             col1.metric(label="💰 Total Sales", value=f"${total_sales:,.1f}")
@@ -412,85 +491,26 @@ if uploaded_file:
             numeric_cols = ['Total Sales', 'Total Profit', 'Total Weight', 'Total CBM']
             avg_cols = ['Avg Profit/Sales', 'Avg Profit/Weight', 'Avg Profit/CBM']
 
+            # Sums, distinct counts, ratio means and order counts for every grouping below
+            # come from one shared pass over the filtered rows, reused across reruns
+            metrics = grouped_metrics(filtered_data)
+            if sketch_scope is not None and sketch_scope.sketches(filtered_data):
+                st.caption(f"Unique Shipments and Unique Customers by Client Level, Destination and Type "
+                           f"are estimates (±{DISTINCT_ERROR:.1%}).")
+
             # Group by Client Level
             st.write("**Grouped by Client Level**")
-            client_level_metrics = filtered_data.groupby("Client level").agg({
-                'Sales total': 'sum',
-                'Profit': 'sum',
-                'WEIGHT': 'sum',
-                'CBM': 'sum',
-                'Shipment NO.': 'nunique',
-                'Client code': 'nunique',
-                'Profit/Sales': 'mean',
-                'Profit/Weight': 'mean',
-                'Profit/CBM': 'mean',
-            }).rename(columns={
-                'Sales total': 'Total Sales',
-                'Profit': 'Total Profit',
-                'WEIGHT': 'Total Weight',
-                'CBM': 'Total CBM',
-                'Shipment NO.': 'Unique Shipments',
-                'Client code': 'Unique Customers',
-                'Profit/Sales': 'Avg Profit/Sales',
-                'Profit/Weight': 'Avg Profit/Weight',
-                'Profit/CBM': 'Avg Profit/CBM'
-            })
-            client_level_metrics['Order Count'] = filtered_data.groupby("Client level").size()
-            client_level_metrics = add_totals_row(client_level_metrics, numeric_cols, avg_cols)
+            client_level_metrics = add_totals_row(metrics.table("Client level", scope=sketch_scope), numeric_cols, avg_cols)
             st.dataframe(client_level_metrics)
 
             # Group by Destination
             st.write("**Grouped by Destination**")
-            destination_metrics = filtered_data.groupby("Destination").agg({
-                'Sales total': 'sum',
-                'Profit': 'sum',
-                'WEIGHT': 'sum',
-                'CBM': 'sum',
-                'Shipment NO.': 'nunique',
-                'Client code': 'nunique',
-                'Profit/Sales': 'mean',
-                'Profit/Weight': 'mean',
-                'Profit/CBM': 'mean',
-            }).rename(columns={
-                'Sales total': 'Total Sales',
-                'Profit': 'Total Profit',
-                'WEIGHT': 'Total Weight',
-                'CBM': 'Total CBM',
-                'Shipment NO.': 'Unique Shipments',
-                'Client code': 'Unique Customers',
-                'Profit/Sales': 'Avg Profit/Sales',
-                'Profit/Weight': 'Avg Profit/Weight',
-                'Profit/CBM': 'Avg Profit/CBM'
-            })
-            destination_metrics['Order Count'] = filtered_data.groupby("Destination").size()
-            destination_metrics = add_totals_row(destination_metrics, numeric_cols, avg_cols)
+            destination_metrics = add_totals_row(metrics.table("Destination", scope=sketch_scope), numeric_cols, avg_cols)
             st.dataframe(destination_metrics)
 
             # Group by Type
             st.write("**Grouped by Type**")
-            type_metrics = filtered_data.groupby("Type").agg({
-                'Sales total': 'sum',
-                'Profit': 'sum',
-                'WEIGHT': 'sum',
-                'CBM': 'sum',
-                'Shipment NO.': 'nunique',
-                'Client code': 'nunique',
-                'Profit/Sales': 'mean',
-                'Profit/Weight': 'mean',
-                'Profit/CBM': 'mean',
-            }).rename(columns={
-                'Sales total': 'Total Sales',
-                'Profit': 'Total Profit',
-                'WEIGHT': 'Total Weight',
-                'CBM': 'Total CBM',
-                'Shipment NO.': 'Unique Shipments',
-                'Client code': 'Unique Customers',
-                'Profit/Sales': 'Avg Profit/Sales',
-                'Profit/Weight': 'Avg Profit/Weight',
-                'Profit/CBM': 'Avg Profit/CBM'
-            })
-            type_metrics['Order Count'] = filtered_data.groupby("Type").size()
-            type_metrics = add_totals_row(type_metrics, numeric_cols, avg_cols)
+            type_metrics = add_totals_row(metrics.table("Type", scope=sketch_scope), numeric_cols, avg_cols)
             st.dataframe(type_metrics)
 
             # Group by User-Selected Column
@@ -499,29 +519,9 @@ if uploaded_file:
                 options=["Category1", "Category2", "Description in EN", "Description in CN"],
                 index=0
             )
+            filtered_data = with_columns(filtered_data, [group_column])
             st.write(f"**Grouped by {group_column}**")
-            custom_group_metrics = filtered_data.groupby(group_column).agg({
-                'Sales total': 'sum',
-                'Profit': 'sum',
-                'WEIGHT': 'sum',
-                'CBM': 'sum',
-                'Shipment NO.': 'nunique',
-                'Client code': 'nunique',
-                'Profit/Sales': 'mean',
-                'Profit/Weight': 'mean',
-                'Profit/CBM': 'mean',
-            }).rename(columns={
-                'Sales total': 'Total Sales',
-                'Profit': 'Total Profit',
-                'WEIGHT': 'Total Weight',
-                'CBM': 'Total CBM',
-                'Shipment NO.': 'Unique Shipments',
-                'Client code': 'Unique Customers',
-                'Profit/Sales': 'Avg Profit/Sales',
-                'Profit/Weight': 'Avg Profit/Weight',
-                'Profit/CBM': 'Avg Profit/CBM'
-            })
-            custom_group_metrics['Order Count'] = filtered_data.groupby(group_column).size()
+            custom_group_metrics = metrics.table(group_column, filtered_data[group_column])
             custom_group_metrics = add_totals_row(custom_group_metrics, numeric_cols, avg_cols)
             st.dataframe(custom_group_metrics)
 
@@ -575,13 +575,9 @@ if uploaded_file:
                 .reset_index()
             )
 
-            # Calculate yearly totals for each metric
-            yearly_totals = monthly_aggregated[['Total Sales', 'Total Profit', 'Total Cost', 
-                                                'Total Weight', 'Total Volume', 'Total Shipments', 'Total Orders']].sum()
-
-            # Add percentage share columns for each metric
+            # Add each metric's percentage share of the yearly total
             for column in ['Total Sales', 'Total Profit', 'Total Cost', 'Total Weight', 'Total Volume', 'Total Shipments']:
-                monthly_aggregated[f"{column} %"] = (monthly_aggregated[column] / yearly_totals[column]) * 100
+                monthly_aggregated[f"{column} %"] = share(monthly_aggregated, column)
 
             # Map month numbers to names
             month_mapping = {
@@ -729,8 +725,8 @@ if uploaded_file:
                         "Category1", "Category2", "Type", "Loading warehouse", "Month"],
                 index=0  # Default to "Destination"
             )
-        # Copy data for analysis to avoid modifying the original dataset
-        analysis_data = filtered_data.copy()
+        # Shallow copy: the columns added below do not modify filtered_data
+        analysis_data = filtered_data.copy(deep=False)
 
         #st.write(analysis_data)
 
@@ -778,7 +774,7 @@ if uploaded_file:
             else:
                 # Aggregate by selected basis
                 aggregated_data = (
-                    analysis_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+                    sum_by(analysis_data, aggregation_basis, numeric_metric, scope)
                 )
                 x_axis = aggregation_basis  # Use selected basis for the x-axis
 
@@ -965,7 +961,7 @@ if uploaded_file:
         #         )
 
         #         # Create a combined column for unique coloring
-        #         melted_data["Category_Metric"] = melted_data[trend_category] + " - " + melted_data["Metric"]
+        #         melted_data["Category_Metric"] = melted_data[trend_category].astype(str) + " - " + melted_data["Metric"]
 
         #         # Create a chart with distinct colors for each Category + Metric combination
         #         sales_cost_chart = px.line(
@@ -1069,27 +1065,22 @@ if uploaded_file:
         if not filtered_data.empty:
             # Group data based on aggregation level
             if profit_aggregation_level == "Daily":
-                profit_data = filtered_data.groupby(["DATE", profit_category])["Profit"].sum().reset_index()
+                profit_data = sum_by(filtered_data, ["DATE", profit_category], "Profit", scope)
                 x_axis = "DATE"
                 title = f"Profit by {profit_category} (Daily)"
             else:
-                profit_data = filtered_data.groupby(["Month Name", profit_category])["Profit"].sum().reset_index()
+                profit_data = filtered_data.groupby(["Month Name", profit_category], observed=True)["Profit"].sum().reset_index()
                 x_axis = "Month Name"
                 title = f"Profit by {profit_category} (Monthly)"
 
             # Add percentage column based on user selection
             if percentage_method == "Yearly Percentage":
                 # Calculate yearly percentage
-                yearly_totals = profit_data.groupby(profit_category)["Profit"].sum().reset_index()
-                yearly_totals.rename(columns={"Profit": "Yearly Total Profit"}, inplace=True)
-                profit_data = profit_data.merge(yearly_totals, on=profit_category)
-                profit_data["Profit %"] = (profit_data["Profit"] / profit_data["Yearly Total Profit"]) * 100
+                profit_data["Yearly Total Profit"] = group_totals(profit_data, "Profit", profit_category)
+                profit_data["Profit %"] = share(profit_data, "Profit", profit_category)
             else:
                 # Calculate within period percentage
-                profit_data["Profit %"] = (
-                    profit_data.groupby(x_axis)["Profit"]
-                    .transform(lambda x: (x / x.sum()) * 100)
-                )
+                profit_data["Profit %"] = share(profit_data, "Profit", x_axis)
 
             # Show all categories by default
             category_values = profit_data[profit_category].unique().tolist()
@@ -1157,7 +1148,8 @@ if uploaded_file:
         st.write(client_data)
 
         # Dynamically identify categorical columns in the dataset
-        categorical_columns = client_data.select_dtypes(include=['object', 'category']).columns.tolist()
+        categorical_columns = catalog.columns("categorical", client_data)
+        categorical_columns += deferred_columns(client_data)
 
         # Dropdown for selecting the grouping column
         selected_group_column = st.selectbox(
@@ -1165,9 +1157,10 @@ if uploaded_file:
             options=categorical_columns,
             index=0  # Default to the first categorical column
         )
+        client_data = with_columns(client_data, [selected_group_column])
 
         # Group data by the selected column and calculate total profit
-        category_profit = client_data.groupby(selected_group_column)["Profit"].sum().reset_index()
+        category_profit = client_data.groupby(selected_group_column, observed=True)["Profit"].sum().reset_index()
 
 
         # Group data by Category and calculate total profit
@@ -1191,13 +1184,14 @@ if uploaded_file:
 
 
         # Section Header
-        st.header("Top 20 Categories by Numeric Columns")
+        st.header("Top Categories by Numeric Columns")
 
         # Exclude specific columns from categorical selection
         exclude_columns = ['Month', 'Shipment NO.']
 
         # Dropdown to select the categorical column
-        categorical_columns = filtered_data.select_dtypes(include=['object', 'category']).columns.tolist()
+        categorical_columns = catalog.columns("categorical", filtered_data)
+        categorical_columns += deferred_columns(filtered_data)
         filtered_categorical_columns = [col for col in categorical_columns if col not in exclude_columns]
 
         selected_category_column = st.selectbox(
@@ -1205,9 +1199,10 @@ if uploaded_file:
             options=filtered_categorical_columns,
             index=0  # Default to the first category
         )
+        filtered_data = with_columns(filtered_data, [selected_category_column])
 
         # Extend numeric columns with additional options
-        numeric_columns = filtered_data.select_dtypes(include=['number']).columns.tolist()
+        numeric_columns = catalog.columns("numeric", filtered_data)
         additional_numeric_options = ['# of Orders', '# of Shipments', '# of Customers']
         numeric_columns.extend(additional_numeric_options)
 
@@ -1218,43 +1213,51 @@ if uploaded_file:
             index=0  # Default to the first numeric column
         )
 
+        # Number of categories shown, and whether the remaining ones are added up in one more bar
+        col1, col2 = st.columns(2)
+        with col1:
+            top_count = st.slider("Number of Categories", min_value=5, max_value=100, value=TOP_K, step=5)
+        with col2:
+            show_others = st.checkbox('Add an "Others" bar for the remaining categories', value=False)
+
         # Calculate the grouped data based on user selection
         if selected_numeric_column == '# of Orders':
-            top_categories = (
-                filtered_data.groupby(selected_category_column)
-                .size()
-                .reset_index(name='# of Orders')
-                .sort_values(by='# of Orders', ascending=False)
-                .head(20)
-            )
+            grouped_categories = size_by(filtered_data, selected_category_column, scope, name='# of Orders')
         elif selected_numeric_column == '# of Shipments':
-            top_categories = (
-                filtered_data.groupby(selected_category_column)['Shipment NO.']
+            grouped_categories = (
+                filtered_data.groupby(selected_category_column, observed=True)['Shipment NO.']
                 .nunique()
                 .reset_index(name='# of Shipments')
-                .sort_values(by='# of Shipments', ascending=False)
-                .head(20)
             )
         elif selected_numeric_column == '# of Customers':
-            top_categories = (
-                filtered_data.groupby(selected_category_column)['Client code']
+            grouped_categories = (
+                filtered_data.groupby(selected_category_column, observed=True)['Client code']
                 .nunique()
                 .reset_index(name='# of Customers')
-                .sort_values(by='# of Customers', ascending=False)
-                .head(20)
             )
         else:
-            top_categories = (
-                filtered_data.groupby(selected_category_column)[selected_numeric_column]
-                .sum()
-                .reset_index()
-                .sort_values(by=selected_numeric_column, ascending=False)
-                .head(20)
-            )
+            grouped_categories = sum_by(filtered_data, selected_category_column, selected_numeric_column, scope)
+
+        # Distinct counts do not add up across categories: the "Others" bar counts the
+        # rows of the remaining categories instead
+        distinct_columns = {'# of Shipments': 'Shipment NO.', '# of Customers': 'Client code'}
+
+        def remaining_distinct(top):
+            categories = filtered_data[selected_category_column]
+            rest = categories.notna() & ~categories.isin(top[selected_category_column])
+            return filtered_data.loc[rest, distinct_columns[selected_numeric_column]].nunique()
+
+        # Only the top categories are selected (partial selection) and sorted, largest first
+        others = None
+        if show_others and len(grouped_categories) > top_count:
+            others = f"Others ({len(grouped_categories) - top_count} more)"
+        top_categories = top_rows(
+            grouped_categories, selected_numeric_column, top_count, others,
+            remaining_distinct if selected_numeric_column in distinct_columns else None
+        )
 
-        # Create a rank column for gradient coloring and sort explicitly for plotting
-        top_categories = top_categories.sort_values(by=selected_numeric_column, ascending=False).reset_index(drop=True)
-        top_categories["Rank"] = top_categories[selected_numeric_column].rank(method="first", ascending=False)
+        # Create a rank column for gradient coloring
+        top_categories["Rank"] = np.arange(1, len(top_categories) + 1)
 
         # Display the grouped data for verification
         st.write(top_categories)
@@ -1265,7 +1268,7 @@ if uploaded_file:
             x=selected_numeric_column,
             y=selected_category_column,
             orientation="h",  # Horizontal bar chart
-            title=f"Top 20 {selected_category_column} by {selected_numeric_column}",
+            title=f"Top {top_count} {selected_category_column} by {selected_numeric_column}",
             labels={selected_category_column: "Category", selected_numeric_column: "Value"},
             text=selected_numeric_column  # Display values on bars
         )
@@ -1331,6 +1334,7 @@ if uploaded_file:
                 index=4,  # Default to "Category1"
                 key="dynamic_breakdown_secondary_dimension"
             )
+        filtered_data = with_columns(filtered_data, [aggregation_basis, secondary_dimension])
 
         # Radio Selector for Display Option
         display_option = st.radio(
@@ -1345,11 +1349,7 @@ if uploaded_file:
         # Generate the Chart Based on User Selections
         if not filtered_data.empty:  # Ensure there is data to display
             # Group data by selected aggregation_basis and secondary_dimension
-            aggregated_data = (
-                filtered_data.groupby([aggregation_basis, secondary_dimension])[numeric_metric]
-                .sum()
-                .reset_index()
-            )
+            aggregated_data = sum_by(filtered_data, [aggregation_basis, secondary_dimension], numeric_metric, scope)
 
 
             st.write(aggregated_data)
@@ -1357,10 +1357,7 @@ if uploaded_file:
             # Handle percentage share calculation if selected
             if display_option == "Percentage Share":
                 # Calculate percentage share within each aggregation_basis group
-                aggregated_data["Percentage"] = (
-                    aggregated_data.groupby(aggregation_basis)[numeric_metric]
-                    .transform(lambda x: x / x.sum() * 100)
-                )
+                aggregated_data["Percentage"] = share(aggregated_data, numeric_metric, aggregation_basis)
                 y_axis = "Percentage"  # Use percentage column for chart
                 y_label = "Percentage Share (%)"
                 chart_title = f"{numeric_metric} Percentage Share by {aggregation_basis} and {secondary_dimension}"
@@ -1689,7 +1686,7 @@ if uploaded_file:
 
             # Generate Stacked Bar Chart
             st.header(f"Stacked Bar Chart: {categorical1} and {categorical2}")
-            aggregated_data = filtered_data.groupby([categorical1, categorical2]).size().reset_index(name="Count")
+            aggregated_data = size_by(filtered_data, [categorical1, categorical2], scope, name="Count")
             fig = px.bar(
                 aggregated_data,
                 x=categorical1,
@@ -1716,7 +1713,7 @@ if uploaded_file:
             if categorical2 == "None":
                 # Generate Grouped Bar Chart
                 st.header(f"Grouped Bar Chart: {numeric_column} by {categorical1}")
-                aggregated_data = filtered_data.groupby(categorical1)[numeric_column].sum().reset_index()
+                aggregated_data = sum_by(filtered_data, categorical1, numeric_column, scope)
                 fig = px.bar(
                     aggregated_data,
                     x=categorical1,
@@ -1727,7 +1724,7 @@ if uploaded_file:
             else:
                 # Generate Stacked Bar Chart
                 st.header(f"Stacked Bar Chart: {numeric_column} by {categorical1} and {categorical2}")
-                aggregated_data = filtered_data.groupby([categorical1, categorical2])[numeric_column].sum().reset_index()
+                aggregated_data = sum_by(filtered_data, [categorical1, categorical2], numeric_column, scope)
                 fig = px.bar(
                     aggregated_data,
                     x=categorical1,
@@ -1747,6 +1744,8 @@ if uploaded_file:
         # Create the Business Assessment page
         def business_assessment():
             st.title("Business Assessment")
+            # Every section groups the whole dataset, read off the daily cube where it can
+            data_scope = cube_scope(data)
 
             # Section 1: Profitability Analysis
             st.header("1. Profitability Analysis")
@@ -1756,13 +1755,13 @@ if uploaded_file:
             with col2:
                 aggregation = st.selectbox("Aggregate By", options=categorical_columns, index=0)
             if metric and aggregation:
-                agg_data = data.groupby(aggregation)[metric].sum().reset_index()
+                agg_data = sum_by(data, aggregation, metric, data_scope)
                 fig = px.bar(agg_data, x=aggregation, y=metric, color=aggregation, title=f"{metric} by {aggregation}")
                 st.plotly_chart(fig)
 
             # Section 2: Cost Efficiency
             st.header("2. Cost Efficiency")
-            cost_efficiency = data.groupby("Category1")[["Cost total", "Sales total"]].sum().reset_index()
+            cost_efficiency = sum_by(data, "Category1", ["Cost total", "Sales total"], data_scope)
             fig2 = px.bar(
                 cost_efficiency,
                 x="Category1",
@@ -1775,7 +1774,7 @@ if uploaded_file:
 
             # Section 3: Volume and Weight Analysis
             st.header("3. Volume and Weight Analysis")
-            volume_weight = data.groupby("Category1")[["CBM", "WEIGHT"]].sum().reset_index()
+            volume_weight = sum_by(data, "Category1", ["CBM", "WEIGHT"], data_scope)
             fig3 = px.scatter(
                 volume_weight,
                 x="CBM",
@@ -1789,7 +1788,7 @@ if uploaded_file:
 
             # Section 4: Shipment Trends
             st.header("4. Shipment Trends")
-            shipment_trend = data.groupby("DATE")[["Sales total", "Cost total"]].sum().reset_index()
+            shipment_trend = sum_by(data, "DATE", ["Sales total", "Cost total"], data_scope)
             fig4 = px.line(
                 shipment_trend,
                 x="DATE",
@@ -1801,7 +1800,7 @@ if uploaded_file:
 
             # Section 5: Client Segmentation
             st.header("5. Client Segmentation")
-            client_segmentation = data.groupby("Client level")[["Profit", "Sales total"]].sum().reset_index()
+            client_segmentation = sum_by(data, "Client level", ["Profit", "Sales total"], data_scope)
             fig5 = px.bar(
                 client_segmentation,
                 x="Client level",
@@ -1852,32 +1851,30 @@ if uploaded_file:
         # Step 3: Filter Data for Each Period
         if not filtered_data.empty:
             # Filter for Period 1
-            period_1_data = filtered_data[
-                (filtered_data['DATE'] >= pd.to_datetime(start_date_1)) &
-                (filtered_data['DATE'] <= pd.to_datetime(end_date_1))
-            ]
+            period_1_data = date_index(data).filter(filtered_data, start_date_1, end_date_1)
             # Aggregate data for Period 1
-            period_1_agg = period_1_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+            period_1_agg = sum_by(period_1_data, aggregation_basis, numeric_metric,
+                                  narrow_scope(scope, start_date_1, end_date_1))
             period_1_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 1)"}, inplace=True)
 
             # Filter for Period 2
-            period_2_data = filtered_data[
-                (filtered_data['DATE'] >= pd.to_datetime(start_date_2)) &
-                (filtered_data['DATE'] <= pd.to_datetime(end_date_2))
-            ]
+            period_2_data = date_index(data).filter(filtered_data, start_date_2, end_date_2)
             # Aggregate data for Period 2
-            period_2_agg = period_2_data.groupby(aggregation_basis)[numeric_metric].sum().reset_index()
+            period_2_agg = sum_by(period_2_data, aggregation_basis, numeric_metric,
+                                  narrow_scope(scope, start_date_2, end_date_2))
             period_2_agg.rename(columns={numeric_metric: f"{numeric_metric} (Period 2)"}, inplace=True)
 
             # Step 4: Merge Period 1 and Period 2 Data
-            comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(0)
+            comparison_data = pd.merge(period_1_agg, period_2_agg, on=aggregation_basis, how="outer").fillna(
+                {f"{numeric_metric} (Period 1)": 0, f"{numeric_metric} (Period 2)": 0}
+            )
 
             # Calculate Percentage Difference
             comparison_data["% Difference"] = (
                 (comparison_data[f"{numeric_metric} (Period 2)"] - comparison_data[f"{numeric_metric} (Period 1)"]) /
                 comparison_data[f"{numeric_metric} (Period 1)"].replace(0, np.nan)
             ) * 100
-            comparison_data["% Difference"].fillna(0, inplace=True)
+            comparison_data["% Difference"] = comparison_data["% Difference"].fillna(0)
 
             # Step 5: Visualize the Comparison
             st.subheader(f"Comparison of {numeric_metric} by {aggregation_basis}")